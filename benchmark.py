@@ -0,0 +1,133 @@
+"""
+Description: Benchmark of the stages in main.py on synthetic radar data. Each stage is timed, and the peak memory
+of each stage is measured with tracemalloc in a second run, such that the tracing does not affect the timing.
+With --startup, the time it takes to start a new process and import the detection, with and without plotting, is measured instead.
+Example: python benchmark.py --scans 1000 --targets 40 --merges 20
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import matplotlib
+matplotlib.use('Agg')
+import import_data_from_json
+import merged_measurement
+import plotting
+import utilities
+from synthetic_data import generate_rosbag_json
+
+def run_stages(file_path, work_dir, save_dir, number_of_plots, expired_track_lifetime=None):
+    """
+    Runs the stages of main.py on a file, and yields the name of each stage after it is done
+    """
+    measurement_dict = import_data_from_json.import_data_from_json(file_path)
+    measurement_dict.pop('Timestamp')
+    yield "import_data_from_json"
+    measurement_dict = utilities.filter_out_measurements_outside_area(measurement_dict, utilities.area_vertices)
+    yield "filter_out_measurements_outside_area"
+    merged_measurements_object = merged_measurement.ComputeMergeMeasurements(measurement_dict, os.path.basename(file_path),
+                                                                             expired_track_lifetime)
+    # The prints of the detection are not part of the benchmark output
+    merged_measurements_object.verbose = False
+    yield "establish_tracks"
+    merged_measurements_object.check_for_merge_measurements()
+    yield "check_for_merge_measurements"
+    merged_measurements = merged_measurements_object.new_merged_measurements[:number_of_plots]
+    plotting.plot_for_report(measurement_dict, merged_measurements, save_dir, os.path.basename(file_path), work_dir)
+    yield "plot_for_report"
+
+def time_stages(*args):
+    times = {}
+    start = time.perf_counter()
+    for stage in run_stages(*args):
+        end = time.perf_counter()
+        times[stage] = end - start
+        start = end
+    return times
+
+def measure_peak_memory(*args):
+    peaks = {}
+    tracemalloc.start()
+    tracemalloc.reset_peak()
+    for stage in run_stages(*args):
+        peaks[stage] = tracemalloc.get_traced_memory()[1]
+        tracemalloc.reset_peak()
+    tracemalloc.stop()
+    return peaks
+
+# Statements run in new processes by --startup, the first one measures the startup of the interpreter itself
+startup_statements = [("python", "pass"),
+                      ("detection (main)", "import main"),
+                      ("export without plotting", "import export_results"),
+                      ("detection and plotting", "import main, plotting"),
+                      ("detection, plotting and video", "import main, plotting, cv2, progressbar")]
+
+def measure_startup_time(statement, repeats):
+    """
+    Returns the shortest wall time of running statement in a new Python process
+    """
+    work_dir = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", statement], cwd=work_dir, check=True)
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+def print_startup_times(repeats):
+    print(f"{'Imports':<40}{'Startup [s]':>12}{'Import cost [s]':>17}")
+    python_time = None
+    for name, statement in startup_statements:
+        startup_time = measure_startup_time(statement, repeats)
+        if python_time is None:
+            python_time = startup_time
+        print(f"{name:<40}{startup_time:>12.3f}{startup_time - python_time:>17.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the merged measurement detection on synthetic radar data")
+    parser.add_argument("--scans", type=int, default=500, help="Number of scans")
+    parser.add_argument("--targets", type=int, default=20, help="Number of targets in each scan")
+    parser.add_argument("--merges", type=int, default=10, help="Number of merge events")
+    parser.add_argument("--noise", type=float, default=0.5, help="Standard deviation of the position noise [m]")
+    parser.add_argument("--clutter", type=int, default=5, help="Number of clutter clusters, not of type 3, in each scan")
+    parser.add_argument("--seed", type=int, default=0, help="Seed of the synthetic data")
+    parser.add_argument("--plots", type=int, default=3, help="Number of merged measurements to plot in plot_for_report")
+    parser.add_argument("--expired-track-lifetime", type=float, default=None,
+                        help="Time in seconds that tracks are kept after their last measurement. By default they are kept for the whole file, "
+                             "which gives the original results but is slow for long files. A lifetime, e.g. 600, is faster, but changes which "
+                             "merged measurements are removed by the tracks, see expired_track_lifetime in main.py")
+    parser.add_argument("--no-memory", action="store_true", help="Skip the run measuring the peak memory of each stage")
+    parser.add_argument("--startup", action="store_true", help="Measure the startup time of new processes instead")
+    parser.add_argument("--repeats", type=int, default=5, help="Number of processes started for each measurement of --startup")
+    args = parser.parse_args()
+
+    if args.startup:
+        print_startup_times(args.repeats)
+        return
+
+    work_dir = os.path.dirname(os.path.abspath(__file__))
+    with tempfile.TemporaryDirectory() as temp_dir:
+        file_path = os.path.join(temp_dir, "rosbag_synthetic.json")
+        generate_rosbag_json(file_path, number_of_scans=args.scans, targets_per_scan=args.targets, number_of_merge_events=args.merges,
+                             position_noise=args.noise, clutter_per_scan=args.clutter, seed=args.seed)
+        print(f"Synthetic file with {args.scans} scans, {args.targets} targets, {args.merges} merge events: "
+              f"{os.path.getsize(file_path) / 1e6:.1f} MB")
+
+        stage_arguments = (file_path, work_dir, temp_dir, args.plots, args.expired_track_lifetime)
+        times = time_stages(*stage_arguments)
+        peaks = {} if args.no_memory else measure_peak_memory(*stage_arguments)
+
+    print(f"{'Stage':<40}{'Time [s]':>10}{'Scans/s':>12}{'Peak memory [MB]':>18}")
+    for stage, stage_time in times.items():
+        peak = f"{peaks[stage] / 1e6:.1f}" if stage in peaks else "-"
+        print(f"{stage:<40}{stage_time:>10.3f}{args.scans / stage_time:>12.0f}{peak:>18}")
+    print(f"{'Total':<40}{sum(times.values()):>10.3f}{args.scans / sum(times.values()):>12.0f}")
+    # ru_maxrss is given in kilobytes on Linux
+    print(f"Peak resident memory of the process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1e3:.1f} MB")
+
+if __name__ == "__main__":
+    main()
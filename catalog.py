@@ -0,0 +1,165 @@
+"""
+Description: SQLite catalog of the processed rosbag files and the merged measurements found in them, such that batch
+runs can skip the files that are already processed, and the merged measurements of all the files can be queried
+without running the detection again.
+Example: python catalog.py catalog.sqlite
+"""
+import json
+import os
+import sqlite3
+import sys
+import time
+
+schema = """
+CREATE TABLE IF NOT EXISTS files (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL,
+    filename TEXT NOT NULL,
+    size INTEGER,
+    mtime_ns INTEGER,
+    parameters TEXT NOT NULL,
+    status TEXT NOT NULL,
+    error TEXT,
+    processed_at REAL,
+    elapsed REAL,
+    timings TEXT,
+    number_of_merged_measurements INTEGER,
+    UNIQUE (path, parameters)
+);
+CREATE INDEX IF NOT EXISTS files_filename ON files (filename);
+CREATE TABLE IF NOT EXISTS merged_measurements (
+    id INTEGER PRIMARY KEY,
+    file_id INTEGER NOT NULL REFERENCES files (id) ON DELETE CASCADE,
+    number INTEGER NOT NULL,
+    prev_timestamp REAL,
+    prev_x1 REAL,
+    prev_y1 REAL,
+    prev_x2 REAL,
+    prev_y2 REAL,
+    prev_area1 REAL,
+    prev_area2 REAL,
+    prev_index1 INTEGER,
+    prev_index2 INTEGER,
+    distance_between REAL,
+    current_timestamp REAL,
+    current_x REAL,
+    current_y REAL,
+    current_area REAL,
+    current_index INTEGER,
+    track_id1 INTEGER,
+    track_id2 INTEGER,
+    current_track_id INTEGER
+);
+CREATE INDEX IF NOT EXISTS merged_measurements_file_id ON merged_measurements (file_id);
+"""
+
+class Catalog:
+    """
+    Class for reading and writing the catalog. A file is identified by its path and the parameters it was processed with,
+    and it is considered processed if it is marked as done and has the same size and modification time as when it was processed.
+    Each file is written in one transaction, so a crash in the middle of a batch only loses the file being processed.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.connection = sqlite3.connect(path)
+        self.connection.row_factory = sqlite3.Row
+        self.connection.execute("PRAGMA foreign_keys = ON")
+        self.connection.executescript(schema)
+
+    def close(self):
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+        return False
+
+    def is_processed(self, file_path, parameters):
+        row = self.connection.execute("SELECT size, mtime_ns FROM files WHERE path = ? AND parameters = ? AND status = 'done'",
+                                      (os.path.abspath(file_path), json.dumps(parameters, sort_keys=True))).fetchone()
+        if row is None:
+            return False
+        try:
+            stat = os.stat(file_path)
+        except OSError:
+            # The file is moved or deleted, so it is left to the processing to report it
+            return False
+        return row["size"] == stat.st_size and row["mtime_ns"] == stat.st_mtime_ns
+
+    def get_unprocessed_files(self, path_list, parameters):
+        return [file_path for file_path in path_list if not self.is_processed(file_path, parameters)]
+
+    def add_file(self, file_path, parameters, merged_measurements=(), elapsed=None, timings=None, error=None):
+        """
+        Records the result of processing a file, replacing any earlier result with the same parameters.
+        If error is given, the file is marked as failed, such that it is processed again by the next batch.
+        The size and modification time of a failed file are left empty if the file can not be found.
+        """
+        try:
+            stat = os.stat(file_path)
+            size, mtime_ns = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            if error is None:
+                raise
+            size, mtime_ns = None, None
+        with self.connection:
+            self.connection.execute("DELETE FROM files WHERE path = ? AND parameters = ?",
+                                    (os.path.abspath(file_path), json.dumps(parameters, sort_keys=True)))
+            cursor = self.connection.execute(
+                "INSERT INTO files (path, filename, size, mtime_ns, parameters, status, error, processed_at, elapsed, timings, "
+                "number_of_merged_measurements) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (os.path.abspath(file_path), os.path.basename(file_path), size, mtime_ns,
+                 json.dumps(parameters, sort_keys=True), "failed" if error is not None else "done", error, time.time(),
+                 elapsed, json.dumps(timings) if timings is not None else None, len(merged_measurements)))
+            file_id = cursor.lastrowid
+            # The columns of merged_measurements are the keys of MergeMeasurements.to_dict
+            rows = [dict(merged_measurement.to_dict(), file_id=file_id, number=number)
+                    for number, merged_measurement in enumerate(merged_measurements, start=1)]
+            if len(rows) > 0:
+                columns = list(rows[0].keys())
+                self.connection.executemany(f"INSERT INTO merged_measurements ({', '.join(columns)}) "
+                                            f"VALUES ({', '.join(':' + column for column in columns)})", rows)
+        return file_id
+
+    def get_files(self, status=None):
+        if status is None:
+            return [dict(row) for row in self.connection.execute("SELECT * FROM files ORDER BY filename")]
+        return [dict(row) for row in self.connection.execute("SELECT * FROM files WHERE status = ? ORDER BY filename", (status,))]
+
+    def get_filenames_with_merged_measurements(self):
+        rows = self.connection.execute("SELECT DISTINCT filename FROM files WHERE status = 'done' AND number_of_merged_measurements > 0")
+        return set(row["filename"] for row in rows)
+
+    def get_paths_with_merged_measurements(self, root=None):
+        """
+        Returns the paths of the processed files with merged measurements, optionally only the ones inside root
+        """
+        rows = self.connection.execute("SELECT DISTINCT path FROM files WHERE status = 'done' AND number_of_merged_measurements > 0 ORDER BY path")
+        paths = [row["path"] for row in rows]
+        if root is None:
+            return paths
+        root = os.path.join(os.path.abspath(root), "")
+        return [path for path in paths if path.startswith(root)]
+
+    def get_merged_measurements(self, where="1", arguments=()):
+        """
+        Returns the merged measurements of all the processed files, with the filename and parameters of the file.
+        where is an SQL condition on the columns of files and merged_measurements, e.g. "current_area > ?" with arguments (50,).
+        """
+        query = ("SELECT files.filename, files.path, files.parameters, merged_measurements.* FROM merged_measurements "
+                 f"JOIN files ON files.id = merged_measurements.file_id WHERE {where} ORDER BY files.filename, merged_measurements.number")
+        return [dict(row) for row in self.connection.execute(query, arguments)]
+
+def main():
+    catalog_path = sys.argv[1] if len(sys.argv) > 1 else "catalog.sqlite"
+    with Catalog(catalog_path) as catalog:
+        files = catalog.get_files()
+        for file in files:
+            elapsed = f"{file['elapsed']:.1f} s" if file["elapsed"] is not None else "-"
+            print(f"{file['filename']}: {file['status']}, {file['number_of_merged_measurements']} merged measurements, {elapsed}")
+        print(f"{len(files)} files, {len(catalog.get_merged_measurements())} merged measurements")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+"""
+Description: Finds the merged measurements in rosbag files and exports the close measurement pairs, merged measurements
+and tracks to csv, json lines or npz files, without plotting. Neither this module nor the modules it imports use
+matplotlib, cv2 or progressbar, such that it can run on machines without them.
+Example: python export_results.py rosbag_1.json rosbag_2.json --format csv --output-dir results
+"""
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import import_data_from_json
+import merged_measurement
+import utilities
+
+formats = ["csv", "jsonl", "npz"]
+
+def get_tables(merged_measurements_object):
+    """
+    Returns the results of a ComputeMergeMeasurements object as tables, which are dicts from column names to lists of values.
+    The merged measurements include the ones removed by the tracks, marked by kept_by_tracks.
+    The tracks have one row for each measurement in a track.
+    """
+    close_pairs = [pair.to_dict() for pair in merged_measurements_object.close_measurements]
+    kept = set(id(merged) for merged in merged_measurements_object.new_merged_measurements)
+    merged_measurements = [dict(merged.to_dict(), kept_by_tracks=id(merged) in kept) for merged in merged_measurements_object.merged_measurements]
+
+    tracks = merged_measurements_object.tracks
+    track_table = {"track_id": np.repeat([track.track_id for track in tracks], [len(track) for track in tracks]).astype(np.int64)}
+    for column, name in [("timestamp", "timestamps"), ("x", "xs"), ("y", "ys")]:
+        track_table[column] = np.concatenate([getattr(track, name) for track in tracks]) if tracks else np.zeros(0)
+
+    return {"close_pairs": get_columns(close_pairs),
+            "merged_measurements": get_columns(merged_measurements),
+            "tracks": {column: values.tolist() for column, values in track_table.items()}}
+
+def get_columns(rows):
+    # Turns a list of dicts with the same keys into a table. A table without rows has no columns.
+    if len(rows) == 0:
+        return {}
+    return {column: [row[column] for row in rows] for column in rows[0]}
+
+def write_csv(path, table):
+    with open(path, 'w', newline='') as file:
+        writer = csv.writer(file)
+        writer.writerow(list(table.keys()))
+        writer.writerows(zip(*table.values()))
+
+def write_jsonl(path, table):
+    columns = list(table.keys())
+    with open(path, 'w') as file:
+        for values in zip(*table.values()):
+            file.write(json.dumps(dict(zip(columns, values))) + "\n")
+
+def get_array(values):
+    # Columns with missing values, e.g. the track ids of merged measurements without tracks, are stored as floats with nan
+    if any(value is None for value in values):
+        return np.array([np.nan if value is None else value for value in values], dtype=float)
+    return np.array(values)
+
+def export_tables(tables, output_dir, name, file_format="csv"):
+    """
+    Writes each table to output_dir, as name_table.csv or name_table.jsonl, or all the tables to name.npz,
+    where the arrays are named table/column. Returns the paths of the written files.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    if file_format == "npz":
+        path = os.path.join(output_dir, f"{name}.npz")
+        np.savez_compressed(path, **{f"{table_name}/{column}": get_array(values)
+                                     for table_name, table in tables.items() for column, values in table.items()})
+        return [path]
+
+    write_table = write_csv if file_format == "csv" else write_jsonl
+    paths = []
+    for table_name, table in tables.items():
+        path = os.path.join(output_dir, f"{name}_{table_name}.{file_format}")
+        write_table(path, table)
+        paths.append(path)
+    return paths
+
+def export_file(file_path, output_dir, file_format="csv", cache_dir=None, expired_track_lifetime=None):
+    """
+    Finds the merged measurements in a file and exports the results, see export_tables.
+    For expired_track_lifetime, see ComputeMergeMeasurements.
+    """
+    filename = os.path.basename(file_path)
+    measurement_dict = import_data_from_json.import_data_from_json(file_path, cache_dir=cache_dir)
+    measurement_dict.pop('Timestamp')
+    measurement_dict = utilities.filter_out_measurements_outside_area(measurement_dict, utilities.area_vertices)
+    merged_measurements_object = merged_measurement.ComputeMergeMeasurements(measurement_dict, filename, expired_track_lifetime)
+    # The prints of the detection are not needed when exporting
+    merged_measurements_object.verbose = False
+    merged_measurements_object.check_for_merge_measurements()
+    paths = export_tables(get_tables(merged_measurements_object), output_dir, os.path.splitext(filename)[0], file_format)
+    return merged_measurements_object, paths
+
+def main():
+    parser = argparse.ArgumentParser(description="Export the merged measurements of rosbag files without plotting")
+    parser.add_argument("files", nargs="+", help="Rosbag json files")
+    parser.add_argument("--format", choices=formats, default="csv", help="Format of the exported files")
+    parser.add_argument("--output-dir", default="results", help="Directory for the exported files")
+    parser.add_argument("--cache-dir", default=None, help="Directory for caching the parsed files")
+    parser.add_argument("--expired-track-lifetime", type=float, default=None,
+                        help="Time in seconds that tracks are kept after their last measurement. By default they are kept for the whole file, "
+                             "which gives the original results but is slow for long files. A lifetime, e.g. 600, is faster, but changes which "
+                             "merged measurements are removed by the tracks, see expired_track_lifetime in main.py")
+    args = parser.parse_args()
+
+    for file_path in args.files:
+        merged_measurements_object, paths = export_file(file_path, args.output_dir, args.format, args.cache_dir,
+                                                         args.expired_track_lifetime)
+        print(f"{os.path.basename(file_path)}: {len(merged_measurements_object.new_merged_measurements)} merged measurements, "
+              f"written to {', '.join(paths)}")
+
+if __name__ == "__main__":
+    main()
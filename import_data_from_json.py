@@ -1,51 +1,282 @@
+import contextlib
 import json
+import os
+import re
+import shutil
+import hashlib
+import tempfile
 import numpy as np
+import instrumentation
+from measurement_frame import MeasurementFrame
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
-def import_data_from_json(file_path: str):
-    measurement_dict = {}
-    measurement_dict['Timestamp'] = ["x","y","area","polygon_xs","polygon_ys"]
-    measurement_dict_for_debugging = {}
-    measurement_dict_for_debugging['Timestamp'] = ["x","y","area"]
+def iterate_json_array(file, chunk_size=1 << 20):
+    """
+    Yields the elements of a top-level JSON array one at a time, reading the file in chunks
+    instead of loading the whole document into memory
+    """
+    decoder = json.JSONDecoder()
+    buffer = ""
+    pos = 0
+    eof = False
+    started = False
+    while True:
+        # Skip whitespace and separators between the elements
+        while pos < len(buffer) and buffer[pos] in " \t\r\n,":
+            pos += 1
+        if pos == len(buffer):
+            if eof:
+                raise ValueError("Unexpected end of file while reading JSON array")
+            buffer = file.read(chunk_size)
+            pos = 0
+            eof = buffer == ""
+            continue
+
+        if not started:
+            if buffer[pos] != "[":
+                raise ValueError("Expected a JSON array at the top level of the file")
+            started = True
+            pos += 1
+            continue
+        if buffer[pos] == "]":
+            return
+
+        try:
+            item, end = decoder.raw_decode(buffer, pos)
+        except json.JSONDecodeError:
+            item, end = None, None
+        # The element is only complete if the decoder stopped before the end of the buffer
+        if end is None or (end == len(buffer) and not eof):
+            if eof:
+                raise ValueError("Could not decode element of JSON array")
+            # Read at least as much as is already buffered, such that large elements are not decoded too many times
+            chunk = file.read(max(chunk_size, len(buffer) - pos))
+            eof = chunk == ""
+            buffer = buffer[pos:] + chunk
+            pos = 0
+            continue
+
+        yield item
+        pos = end
+
+# The start of a scan in the rosbag files, and the start of a rosbag file, used by the orjson parser
+scan_start_pattern = re.compile(rb'\{\s*"header"\s*:')
+file_start_pattern = re.compile(rb'\s*\[\s*\{\s*"header"\s*:')
+
+def iterate_json_array_orjson(file, chunk_size=1 << 24):
+    """
+    Yields the scans of a rosbag file opened in binary mode, parsed with orjson. The file is read in chunks and split
+    into scans where a header object starts. A header can also be found inside a scan, so if the text up to the next
+    header is not valid json, the scan is extended to the header after that.
+    """
+    buffer = file.read(chunk_size)
+    # The file starts with the opening bracket of the array, followed by the first scan
+    start = buffer.index(b"{")
+    eof = False
+    while True:
+        for match in scan_start_pattern.finditer(buffer, start + 1):
+            try:
+                item = orjson.loads(buffer[start:match.start()].rstrip(b" \t\r\n,"))
+            except orjson.JSONDecodeError:
+                continue
+            yield item
+            start = match.start()
+        if eof:
+            break
+        # Read at least as much as is already buffered, such that large scans are not searched too many times
+        chunk = file.read(max(chunk_size, len(buffer) - start))
+        eof = chunk == b""
+        buffer = buffer[start:] + chunk
+        start = 0
+
+    # The last scan ends at the end of the array
+    last_item = buffer[start:].rstrip()
+    if not last_item.endswith(b"]"):
+        raise ValueError("Expected the JSON array to end at the end of the file")
+    yield orjson.loads(last_item[:-1].rstrip(b" \t\r\n,"))
+
+def iterate_scan_items(file_path):
+    """
+    Yields the scans of a rosbag file as parsed json. orjson is used if it is installed and the file starts with a scan
+    in the expected format, otherwise the file is parsed with the json module.
+    """
+    if orjson is not None:
+        with open(file_path, 'rb') as file:
+            if file_start_pattern.match(file.read(4096)):
+                file.seek(0)
+                yield from iterate_json_array_orjson(file)
+                return
     with open(file_path, 'r') as file:
-        data = json.load(file)
-    
-    # Define the first timestamp
-    timestamp = data[0]["header"]["stamp"]["secs"]
-    timestamps_nano = data[0]["header"]["stamp"]["nsecs"]
-    first_timestamp = timestamp + timestamps_nano*10**(-9)
-
-    for k, item in enumerate(data):
-        if k == 0:
+        yield from iterate_json_array(file)
+
+def get_timestamp(item):
+    return item["header"]["stamp"]["secs"] + item["header"]["stamp"]["nsecs"]*10**(-9)
+
+def get_measurements_from_scan(item):
+    """
+    Returns the type 3 clusters of a scan as a list of [x, y, area, polygon_xs, polygon_ys]. The hull vertices of all
+    the clusters in the scan are stored in one float32 buffer, and the polygons are views into it.
+    """
+    clusters = [measurement for measurement in item["scan"] if measurement["type"] == 3]
+    points = [point for measurement in clusters for point in measurement["hull"]["points"]]
+    hull_xs = np.array([point["y"] for point in points], dtype=np.float32)
+    hull_ys = np.array([point["x"] for point in points], dtype=np.float32)
+    measurements = []
+    offset = 0
+    for measurement in clusters:
+        centroid = measurement["cluster_centroid"]
+        y = centroid["x"]
+        x = centroid["y"]
+        area = measurement["area"]
+        number_of_points = len(measurement["hull"]["points"])
+        xs = hull_xs[offset:offset+number_of_points]
+        ys = hull_ys[offset:offset+number_of_points]
+        offset += number_of_points
+        measurements.append([x,y,area,xs,ys])
+    return measurements
+
+def iterate_scans(file_path: str):
+    """
+    Streams the rosbag file and yields one (timestamp, measurements) tuple per scan, where the timestamp
+    is relative to the first scan and the measurements are the type 3 clusters of the scan
+    """
+    first_timestamp = None
+    for item in iterate_scan_items(file_path):
+        if first_timestamp is None:
+            first_timestamp = get_timestamp(item)
             timestamp = 0
         else:
-            timestamp = item["header"]["stamp"]["secs"]
-            timestamps_nano = item["header"]["stamp"]["nsecs"]
-            timestamp = timestamp + timestamps_nano*10**(-9) - first_timestamp
-
-        measurement_dict[timestamp] = []
-        # Add a debugging dictionary with only the x, y and area
-        measurement_dict_for_debugging[timestamp] = []
-        item_data = item["scan"]
-        for i, measurement in enumerate(item_data):
-            if measurement["type"] == 3:
-                y = measurement["cluster_centroid"]["x"]
-                x = measurement["cluster_centroid"]["y"]
-                area = measurement["area"]
-                xs = []
-                ys = []
-                for point in measurement["hull"]["points"]:
-                    xs.append(point["y"])
-                    ys.append(point["x"])
-                xs.append(xs[0])
-                ys.append(ys[0])
-            else:
-                continue
-            
-            measurement_dict[timestamp].append([x,y,area,xs,ys])
-            measurement_dict_for_debugging[timestamp].append((x,y,area))
-    np.save('measurement_dict_for_debugging.npy', measurement_dict_for_debugging)
-    np.save('measurement_dict.npy', measurement_dict)
-    return measurement_dict
-       
-        
+            timestamp = get_timestamp(item) - first_timestamp
+        measurements = get_measurements_from_scan(item)
+        instrumentation.count("scans")
+        instrumentation.count("clusters", len(measurements))
+        yield timestamp, measurements
+
+# Increase when the format of the cached files changes, such that old caches are not used
+CACHE_VERSION = 3
+
+def get_file_hash(file_path):
+    sha1 = hashlib.sha1()
+    with open(file_path, 'rb') as file:
+        for chunk in iter(lambda: file.read(1 << 20), b""):
+            sha1.update(chunk)
+    return sha1.hexdigest()
+
+def get_cache_path(file_path, cache_dir):
+    """
+    Returns the cache directory of a rosbag file. The path of the file is part of the name, since files
+    with the same name can be found in several folders.
+    """
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    path_hash = hashlib.sha1(os.path.abspath(file_path).encode()).hexdigest()[:10]
+    return os.path.join(cache_dir, f"{name}_{path_hash}")
+
+def load_cached_frame(file_path, cache_dir):
+    """
+    Returns the cached MeasurementFrame of the file, or None if there is no cache or the file has changed since it was made.
+    The file is considered unchanged if the size and modification time are the same, or if the size and hash are the same.
+    """
+    cache_path = get_cache_path(file_path, cache_dir)
+    try:
+        with open(os.path.join(cache_path, "source.json"), 'r') as file:
+            source = json.load(file)
+    except (OSError, ValueError):
+        return None
+    stat = os.stat(file_path)
+    if source.get("version") != CACHE_VERSION or source.get("size") != stat.st_size:
+        return None
+    if source.get("mtime_ns") != stat.st_mtime_ns:
+        if source.get("sha1") != get_file_hash(file_path):
+            return None
+        # The file is only touched or copied, so the new modification time is stored to avoid hashing it again next time
+        source["mtime_ns"] = stat.st_mtime_ns
+        write_source(source, cache_path)
+    try:
+        return MeasurementFrame.load(cache_path)
+    except (OSError, ValueError):
+        # A damaged or removed cache is parsed again
+        return None
+
+def write_source(source, directory):
+    # The file is replaced in one step, such that it is never read half written
+    temp_fd, temp_path = tempfile.mkstemp(dir=directory, suffix=".json")
+    try:
+        with os.fdopen(temp_fd, 'w') as file:
+            json.dump(source, file)
+        os.replace(temp_path, os.path.join(directory, "source.json"))
+    except OSError:
+        # The cache is removed or replaced by another process in the meantime
+        with contextlib.suppress(OSError):
+            os.remove(temp_path)
+
+def save_cached_frame(frame, file_path, cache_dir):
+    """
+    Saves the frame to the cache of the file. The cache is written to a temporary directory first and then moved,
+    such that other processes never read a half written cache. An old cache is moved aside before the new one is
+    moved in, and only deleted afterwards, so a reader sees either a complete cache or none.
+    """
+    stat = os.stat(file_path)
+    source = {"version": CACHE_VERSION, "path": os.path.abspath(file_path), "size": stat.st_size,
+              "mtime_ns": stat.st_mtime_ns, "sha1": get_file_hash(file_path)}
+    os.makedirs(cache_dir, exist_ok=True)
+    temp_path = tempfile.mkdtemp(dir=cache_dir)
+    frame.save(temp_path)
+    with open(os.path.join(temp_path, "source.json"), 'w') as file:
+        json.dump(source, file)
 
+    cache_path = get_cache_path(file_path, cache_dir)
+    old_path = temp_path + "_old"
+    try:
+        os.rename(cache_path, old_path)
+    except OSError:
+        # There is no old cache, or another process moved it aside
+        old_path = None
+    try:
+        os.rename(temp_path, cache_path)
+    except OSError:
+        # Another process wrote the cache in the meantime
+        shutil.rmtree(temp_path, ignore_errors=True)
+    if old_path is not None:
+        shutil.rmtree(old_path, ignore_errors=True)
+
+def import_frame(file_path: str, cache_dir=None):
+    """
+    Imports the measurements of a rosbag file as a MeasurementFrame. If cache_dir is given, the parsed file is cached there,
+    and later imports of the same file load the memory mapped cache instead of parsing the json file.
+    """
+    if cache_dir is not None:
+        with instrumentation.stage("load_cache"):
+            frame = load_cached_frame(file_path, cache_dir)
+        if frame is not None:
+            instrumentation.count("cache_hits")
+            instrumentation.count("scans", len(frame))
+            instrumentation.count("clusters", frame.number_of_measurements)
+            return frame
+    with instrumentation.stage("parse"):
+        frame = MeasurementFrame.from_scans(iterate_scans(file_path))
+    if cache_dir is not None:
+        with instrumentation.stage("save_cache"):
+            save_cached_frame(frame, file_path, cache_dir)
+    return frame
+
+def import_data_from_json(file_path: str, as_frame=False, cache_dir=None):
+    """
+    Imports the measurements of a rosbag file. If as_frame is True, a columnar MeasurementFrame is returned
+    instead of the measurement_dict. If cache_dir is given, the parsed file is cached there, see import_frame.
+    """
+    if as_frame:
+        return import_frame(file_path, cache_dir)
+
+    measurement_dict = {}
+    measurement_dict['Timestamp'] = ["x","y","area","polygon_xs","polygon_ys"]
+    if cache_dir is not None:
+        measurement_dict.update(import_frame(file_path, cache_dir).items())
+        return measurement_dict
+
+    with instrumentation.stage("parse"):
+        for timestamp, measurements in iterate_scans(file_path):
+            measurement_dict[timestamp] = measurements
+    return measurement_dict
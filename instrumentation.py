@@ -0,0 +1,75 @@
+"""
+Description: Optional timing and counters of the stages in the processing of a file.
+The instrumentation is disabled by default, and then stage returns a shared empty context manager and count returns
+at once, such that the calls can be left in the code.
+Example:
+    instrumentation.enable()
+    with instrumentation.stage("parse"):
+        ...
+    instrumentation.count("scans", number_of_scans)
+    instrumentation.write_summary("summary.json", file="rosbag.json")
+"""
+import contextlib
+import json
+import time
+
+enabled = False
+stage_times = {}
+stage_calls = {}
+counts = {}
+
+_disabled_stage = contextlib.nullcontext()
+
+class Stage:
+    """
+    Context manager adding the wall time of the block to the stage
+    """
+    __slots__ = ("name", "start")
+
+    def __init__(self, name):
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        stage_times[self.name] = stage_times.get(self.name, 0.0) + time.perf_counter() - self.start
+        stage_calls[self.name] = stage_calls.get(self.name, 0) + 1
+        return False
+
+def enable():
+    global enabled
+    enabled = True
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    stage_times.clear()
+    stage_calls.clear()
+    counts.clear()
+
+def stage(name):
+    if not enabled:
+        return _disabled_stage
+    return Stage(name)
+
+def count(name, number=1):
+    if not enabled:
+        return
+    counts[name] = counts.get(name, 0) + number
+
+def summary(**extra):
+    """
+    Returns the recorded stages and counters as a dict that can be written as json, with the extra items added at the top
+    """
+    result = dict(extra)
+    result["stages"] = {name: {"time": stage_times[name], "calls": stage_calls[name]} for name in stage_times}
+    result["counts"] = dict(counts)
+    return result
+
+def write_summary(path, **extra):
+    with open(path, 'w') as file:
+        json.dump(summary(**extra), file, indent=2)
@@ -4,14 +4,17 @@ Email: petthang@stud.ntnu.no
 Date: February 27, 2024
 Description: 
 """
+import catalog
 import import_data_from_json
+import instrumentation
 import merged_measurement
-import plotting
 import utilities
-import matplotlib.pyplot as plt
 import numpy as np
 import glob
 import os
+import fcntl
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 """
 IMPORTANT: Need to change the radar_data_path and wokring_directory to the correct paths!!
@@ -19,36 +22,53 @@ IMPORTANT: Need to change the radar_data_path and wokring_directory to the corre
 # work_dir = "/home/aflaptop/Documents/code_for_checking_merged_measurement/"
 work_dir = os.getcwd()
 radar_data_path = "/home/aflaptop/Documents/radar_data"
+# Directory for the parsed rosbag files, such that they are only parsed once. Set to None to always parse the json files.
+cache_dir = f"{work_dir}/cache"
+# Number of processes used for rendering the report figures of a file
+number_of_plotting_workers = 1
+# Directory for a json summary of the time and counts of each stage per file. Set to None to disable the instrumentation.
+instrumentation_dir = None
+# SQLite catalog of the processed files and their merged measurements, used for skipping the files that are already processed.
+# Set to None to process all the files without recording them.
+catalog_path = f"{work_dir}/catalog.sqlite"
+# The area where merged measurements are looked for
+vertices = utilities.area_vertices
+# Time in seconds that tracks are kept after their last measurement, see utilities.Tracker. None keeps them for the whole file,
+# which gives the original results, but the tracking gets slower with the square of the length of the file. A lifetime keeps
+# long files fast, but changes which merged measurements are removed by the tracks, since a measurement close to a removed
+# track can extend another track instead of starting a new one. Short lifetimes remove most of the merged measurements,
+# e.g. 3 instead of 72 with 4 s on a 20 minute file, while 600 s, as used by OnlineMergeDetector, gave 70.
+expired_track_lifetime = None
 
 
 def write_filenames_to_txt(filename, txt_filename):
     """
-    Writes the filename to the txt file, if the filename is not already written
+    Writes the filename to the txt file, if the filename is not already written.
+    The file is locked while it is read and written, such that several processes can not write the same filename.
     """
-    with open(txt_filename, 'r') as f:
-        lines = f.readlines()
-    files = []
-    for line in lines:
-        files.append(line[:-1])
-
-    already_written = False
-    if os.path.basename(filename) in files:
-        already_written = True
-        print(f"File {os.path.basename(filename)} already written to txt file")
-
-    if not already_written:
-        with open(txt_filename, 'a') as f:
+    with open(txt_filename, 'a+') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        f.seek(0)
+        files = set(line.strip() for line in f)
+
+        if os.path.basename(filename) in files:
+            print(f"File {os.path.basename(filename)} already written to txt file")
+        else:
             f.write(os.path.basename(filename) + "\n")
+        fcntl.flock(f, fcntl.LOCK_UN)
    
 def find_files(root,txt_filename):
     """
-    Finds the files in the root directory that are given in the txt file
+    Finds the files in the root directory that are given in the txt file.
+    If there is a catalog, the paths of the files with merged measurements are read from it instead, such that the
+    folders are not searched. Files that were only written to the txt file before the catalog was made are then not found.
     """
+    if catalog_path is not None and os.path.exists(catalog_path):
+        with catalog.Catalog(catalog_path) as file_catalog:
+            return [path for path in file_catalog.get_paths_with_merged_measurements(root) if os.path.exists(path)]
+
     with open(txt_filename, 'r') as f:
-        lines = f.readlines()
-    files = []
-    for line in lines:
-        files.append(line[:-1])
+        files = set(line.strip() for line in f)
 
     path_list = []
     for item in os.listdir(root):
@@ -63,10 +83,120 @@ def make_new_directory(filename):
     plotting_dir = f"{work_dir}/merged_measurements_plots"
     filename = filename[:-5]
     save_dir = os.path.join(plotting_dir,filename)
-    if not os.path.exists(save_dir):
-        os.mkdir(save_dir)
+    os.makedirs(save_dir, exist_ok=True)
     return save_dir
-  
+
+def process_file(file_path):
+    """
+    Processes a single file, and writes the summary of the stages to instrumentation_dir if it is set
+    """
+    filename = os.path.basename(file_path)
+    print(f"File: {filename}")
+    if instrumentation_dir is not None:
+        instrumentation.enable()
+        instrumentation.reset()
+    with instrumentation.stage("total"):
+        merged_measurements = find_and_plot_merged_measurements(file_path, filename)
+    if instrumentation_dir is not None:
+        os.makedirs(instrumentation_dir, exist_ok=True)
+        instrumentation.write_summary(f"{instrumentation_dir}/{filename[:-5]}.json", file=file_path)
+    return merged_measurements
+
+def find_and_plot_merged_measurements(file_path, filename):
+    """
+    Finds the merged measurements in a single file, and plots them if there are any
+    """
+    measurement_dict = import_data_from_json.import_data_from_json(file_path, cache_dir=cache_dir)
+    measurement_dict.pop('Timestamp')
+
+    measurement_dict = utilities.filter_out_measurements_outside_area(measurement_dict, vertices)
+
+    merged_measurements_object = merged_measurement.ComputeMergeMeasurements(measurement_dict, filename, expired_track_lifetime)
+    merged_measurements_object.check_for_merge_measurements()
+    merged_measurements = merged_measurements_object.new_merged_measurements
+    print(f"Number of merged measurements: {len(merged_measurements)}")
+
+    if len(merged_measurements) == 0:
+        # plotting.plot_for_vizualization_without_merged_measurements(measurement_dict, filename, work_dir)
+        pass
+    else:
+        # plotting.plot_for_vizualization(merged_measurements, measurement_dict, filename, work_dir)
+        # Imported here, such that matplotlib is only loaded for the files that are plotted
+        import plotting
+        save_dir = make_new_directory(filename)
+        plotting.plot_for_report(measurement_dict, merged_measurements, save_dir, filename,work_dir, number_of_plotting_workers)
+    return merged_measurements
+
+def get_parameters():
+    """
+    Returns the parameters the files are processed with, which are recorded in the catalog
+    """
+    parameters = merged_measurement.ComputeMergeMeasurements({}, None, expired_track_lifetime).get_parameters()
+    parameters["vertices"] = vertices
+    return parameters
+
+def process_file_and_time(file_path):
+    """
+    Runs process_file, and returns the merged measurements, the time it took and the instrumentation summary if it is enabled
+    """
+    start = time.perf_counter()
+    merged_measurements = process_file(file_path)
+    timings = instrumentation.summary() if instrumentation.enabled else None
+    return merged_measurements, time.perf_counter() - start, timings
+
+def save_result(file_path, result, txt_filename, file_catalog, parameters):
+    merged_measurements, elapsed, timings = result
+    if len(merged_measurements) > 0:
+        write_filenames_to_txt(file_path, txt_filename)
+    if file_catalog is not None:
+        file_catalog.add_file(file_path, parameters, merged_measurements, elapsed, timings)
+
+def run_batch(path_list, txt_filename, number_of_workers=1):
+    """
+    Processes the files in path_list with number_of_workers processes, and returns the merged measurements of each file.
+    Only this process writes to the txt file and the catalog, when the result of a file is received.
+    Files that are already in the catalog with the same parameters are skipped, such that a stopped batch can be resumed.
+    """
+    results = {}
+    parameters = get_parameters()
+    file_catalog = catalog.Catalog(catalog_path) if catalog_path is not None else None
+    if file_catalog is not None:
+        number_of_files = len(path_list)
+        path_list = file_catalog.get_unprocessed_files(path_list, parameters)
+        if len(path_list) < number_of_files:
+            print(f"Skipping {number_of_files - len(path_list)} files that are already processed")
+
+    if number_of_workers == 1:
+        for i, file_path in enumerate(path_list):
+            print(f"Processing file {i+1} of {len(path_list)}")
+            try:
+                result = process_file_and_time(file_path)
+            except Exception as e:
+                print(f"Failed to process {os.path.basename(file_path)}: {e}")
+                if file_catalog is not None:
+                    file_catalog.add_file(file_path, parameters, error=str(e))
+                continue
+            results[file_path] = result[0]
+            save_result(file_path, result, txt_filename, file_catalog, parameters)
+    else:
+        with ProcessPoolExecutor(max_workers=number_of_workers) as executor:
+            futures = {executor.submit(process_file_and_time, file_path): file_path for file_path in path_list}
+            for i, future in enumerate(as_completed(futures)):
+                file_path = futures[future]
+                print(f"Finished file {i+1} of {len(path_list)}: {os.path.basename(file_path)}")
+                try:
+                    result = future.result()
+                except Exception as e:
+                    print(f"Failed to process {os.path.basename(file_path)}: {e}")
+                    if file_catalog is not None:
+                        file_catalog.add_file(file_path, parameters, error=str(e))
+                    continue
+                results[file_path] = result[0]
+                save_result(file_path, result, txt_filename, file_catalog, parameters)
+
+    if file_catalog is not None:
+        file_catalog.close()
+    return results
 
 
 def main():
@@ -89,35 +219,15 @@ def main():
     
     plot_only_map = False
     if plot_only_map:   
+        import plotting
+        import matplotlib.pyplot as plt
         fig, ax, originx, origin_y = plotting.plot()
         plt.savefig("/home/aflaptop/Desktop/merged_measurement/land_with_and_without_filter.png",dpi=400)
         plt.show()
 
-    for i, file_path in enumerate(path_list):
-        if True:
-            print(f"Processing file {i+1} of {len(path_list)}")
-            filename = os.path.basename(file_path)
-            print(f"File: {filename}")
-            measurement_dict = import_data_from_json.import_data_from_json(file_path)
-            measurement_dict.pop('Timestamp')
-            measurement_dict = utilities.add_color_scaling(measurement_dict)
-
-            vertices = [(100, 0), (100, -40), (0, -80), (-50,-110), (-90, -120), (-105, -110),(-50,-60),(-25,-20),(0,0)]
-            measurement_dict = utilities.filter_out_measurements_outside_area(measurement_dict, vertices)
-    
-            merged_measurements_object = merged_measurement.ComputeMergeMeasurements(measurement_dict, filename)
-            merged_measurements_object.check_for_merge_measurements()
-            merged_measurements = merged_measurements_object.new_merged_measurements
-            print(f"Number of merged measurements: {len(merged_measurements)}")
-            
-            if len(merged_measurements) == 0:
-                # plotting.plot_for_vizualization_without_merged_measurements(measurement_dict, filename, work_dir)
-                continue
-            else:
-                # plotting.plot_for_vizualization(merged_measurements, measurement_dict, filename, work_dir)
-                save_dir = make_new_directory(filename)
-                plotting.plot_for_report(measurement_dict, merged_measurements, save_dir, filename,work_dir)
-                write_filenames_to_txt(file_path, txt_filename)
+    # Number of processes used for processing the files, None uses all the cores
+    number_of_workers = 1
+    run_batch(path_list, txt_filename, number_of_workers)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,163 @@
+import os
+import numpy as np
+from collections.abc import Mapping
+
+class MeasurementFrame(Mapping):
+    """
+    Columnar storage of the measurements in a rosbag file.
+    The measurements of all scans are stored in contiguous arrays, where the measurements of scan i are found
+    between scan_offsets[i] and scan_offsets[i+1]. The hull polygons are stored in flat vertex buffers in the same
+    way, where the polygon of measurement j is found between hull_offsets[j] and hull_offsets[j+1]. The vertices are
+    stored as float32, and the polygons are not closed, i.e. the first vertex is not repeated at the end.
+    The frame can be used in place of a measurement_dict, since indexing it with a timestamp gives the measurements
+    of that scan as [x, y, area, polygon_xs, polygon_ys]. As in a dict, each timestamp is only found once.
+    """
+    # The arrays that make up the frame, in the order of the arguments to __init__
+    array_names = ["timestamps", "scan_offsets", "x", "y", "area", "hull_offsets", "hull_xs", "hull_ys"]
+
+    def __init__(self, timestamps, scan_offsets, x, y, area, hull_offsets, hull_xs, hull_ys):
+        self.timestamps = np.asarray(timestamps, dtype=float)
+        self.scan_offsets = np.asarray(scan_offsets, dtype=np.int64)
+        self.t = np.repeat(self.timestamps, np.diff(self.scan_offsets))
+        self.x = np.asarray(x, dtype=float)
+        self.y = np.asarray(y, dtype=float)
+        self.area = np.asarray(area, dtype=float)
+        self.hull_offsets = np.asarray(hull_offsets, dtype=np.int64)
+        self.hull_xs = np.asarray(hull_xs, dtype=np.float32)
+        self.hull_ys = np.asarray(hull_ys, dtype=np.float32)
+        self.scan_index = {timestamp: i for i, timestamp in enumerate(self.timestamps.tolist())}
+
+    @classmethod
+    def from_scans(cls, scans):
+        """
+        Builds the frame from an iterable of (timestamp, measurements), e.g. import_data_from_json.iterate_scans
+        """
+        timestamps = []
+        scan_offsets = [0]
+        x = []
+        y = []
+        area = []
+        hull_lengths = []
+        hull_xs = []
+        hull_ys = []
+        for timestamp, measurements in scans:
+            timestamps.append(timestamp)
+            for measurement in measurements:
+                x.append(measurement[0])
+                y.append(measurement[1])
+                area.append(measurement[2])
+                hull_xs.append(np.asarray(measurement[3], dtype=np.float32))
+                hull_ys.append(np.asarray(measurement[4], dtype=np.float32))
+                hull_lengths.append(len(hull_xs[-1]))
+            scan_offsets.append(len(x))
+        hull_offsets = np.concatenate(([0], np.cumsum(hull_lengths, dtype=np.int64)))
+        hull_xs = np.concatenate(hull_xs) if hull_xs else np.zeros(0, dtype=np.float32)
+        hull_ys = np.concatenate(hull_ys) if hull_ys else np.zeros(0, dtype=np.float32)
+        frame = cls(timestamps, scan_offsets, x, y, area, hull_offsets, hull_xs, hull_ys)
+        if len(frame.scan_index) < len(timestamps):
+            # A repeated timestamp replaces the measurements of the earlier scan, but keeps its place, as in a dict
+            first_positions = {}
+            for i, timestamp in enumerate(timestamps):
+                first_positions.setdefault(timestamp, i)
+            frame = frame.take_scans([frame.scan_index[timestamp] for timestamp in first_positions])
+        return frame
+
+    @classmethod
+    def load(cls, directory, mmap_mode='r'):
+        """
+        Loads a frame saved with save, where the arrays are memory mapped by default
+        """
+        arrays = [np.load(os.path.join(directory, f"{name}.npy"), mmap_mode=mmap_mode) for name in cls.array_names]
+        return cls(*arrays)
+
+    def save(self, directory):
+        """
+        Saves each array of the frame to a .npy file in directory
+        """
+        os.makedirs(directory, exist_ok=True)
+        for name in self.array_names:
+            np.save(os.path.join(directory, f"{name}.npy"), getattr(self, name))
+
+    @classmethod
+    def from_measurement_dict(cls, measurement_dict):
+        return cls.from_scans(measurement_dict.items())
+
+    def to_measurement_dict(self):
+        return {timestamp: measurements for timestamp, measurements in self.items()}
+
+    @property
+    def number_of_measurements(self):
+        return len(self.x)
+
+    def scan_slice(self, scan_index):
+        return slice(self.scan_offsets[scan_index], self.scan_offsets[scan_index+1])
+
+    def polygon(self, measurement_index):
+        """
+        Returns the xs and ys of the hull polygon of a measurement as views into the vertex buffers
+        """
+        start, end = self.hull_offsets[measurement_index], self.hull_offsets[measurement_index+1]
+        return self.hull_xs[start:end], self.hull_ys[start:end]
+
+    def get_measurement(self, measurement_index):
+        """
+        Returns a measurement as [x, y, area, polygon_xs, polygon_ys]
+        """
+        xs, ys = self.polygon(measurement_index)
+        return [float(self.x[measurement_index]), float(self.y[measurement_index]), float(self.area[measurement_index]), xs, ys]
+
+    def get_measurements(self, measurement_indices):
+        """
+        Returns the measurements at measurement_indices as a list of [x, y, area, polygon_xs, polygon_ys]
+        """
+        measurement_indices = np.asarray(measurement_indices, dtype=np.int64)
+        starts = self.hull_offsets[measurement_indices].tolist()
+        ends = self.hull_offsets[measurement_indices + 1].tolist()
+        return [[x, y, area, self.hull_xs[start:end], self.hull_ys[start:end]]
+                for x, y, area, start, end in zip(self.x[measurement_indices].tolist(), self.y[measurement_indices].tolist(),
+                                                  self.area[measurement_indices].tolist(), starts, ends)]
+
+    def get_scan(self, scan_index):
+        """
+        Returns the measurements of a scan as a list of [x, y, area, polygon_xs, polygon_ys]
+        """
+        return self.get_measurements(np.arange(self.scan_offsets[scan_index], self.scan_offsets[scan_index+1]))
+
+    def select(self, mask):
+        """
+        Returns a new frame with only the measurements where mask is True. All scans are kept, also the empty ones.
+        """
+        mask = np.asarray(mask, dtype=bool)
+        scan_offsets = np.concatenate(([0], np.cumsum(mask)))[self.scan_offsets]
+        hull_lengths = np.diff(self.hull_offsets)
+        hull_mask = np.repeat(mask, hull_lengths)
+        hull_offsets = np.concatenate(([0], np.cumsum(hull_lengths[mask])))
+        return MeasurementFrame(self.timestamps, scan_offsets, self.x[mask], self.y[mask], self.area[mask],
+                                hull_offsets, self.hull_xs[hull_mask], self.hull_ys[hull_mask])
+
+    def take_scans(self, scan_indices):
+        """
+        Returns a new frame with the scans at scan_indices, in that order
+        """
+        scan_indices = np.asarray(scan_indices, dtype=np.int64)
+        scan_lengths = np.diff(self.scan_offsets)[scan_indices]
+        measurement_indices = np.concatenate([np.arange(self.scan_offsets[i], self.scan_offsets[i+1]) for i in scan_indices.tolist()]
+                                             + [np.zeros(0, dtype=np.int64)])
+        hull_lengths = np.diff(self.hull_offsets)[measurement_indices]
+        hull_indices = np.concatenate([np.arange(self.hull_offsets[j], self.hull_offsets[j+1]) for j in measurement_indices.tolist()]
+                                      + [np.zeros(0, dtype=np.int64)])
+        return MeasurementFrame(self.timestamps[scan_indices], np.concatenate(([0], np.cumsum(scan_lengths))),
+                                self.x[measurement_indices], self.y[measurement_indices], self.area[measurement_indices],
+                                np.concatenate(([0], np.cumsum(hull_lengths))), self.hull_xs[hull_indices], self.hull_ys[hull_indices])
+
+    def __getitem__(self, timestamp):
+        return self.get_scan(self.scan_index[timestamp])
+
+    def __iter__(self):
+        return iter(self.timestamps.tolist())
+
+    def __len__(self):
+        return len(self.timestamps)
+
+    def __repr__(self) -> str:
+        return f"MeasurementFrame with {len(self)} scans and {self.number_of_measurements} measurements"
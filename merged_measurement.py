@@ -5,15 +5,37 @@ Date: February 27, 2024
 Description: 
 """
 import numpy as np
-from utilities import euclidean_distance, Track
+import instrumentation
+from itertools import groupby
+from measurement_frame import MeasurementFrame
+from utilities import euclidean_distance, find_close_pairs, Tracker
 
 
+def get_closed_polygon(polygon, origin_x=0, origin_y=0):
+    """
+    Returns the xs and ys of a hull polygon moved by the origin, with the first vertex repeated at the end to close the ring
+    """
+    xs = np.asarray(polygon[0], dtype=float)
+    ys = np.asarray(polygon[1], dtype=float)
+    return np.append(xs, xs[:1]) + origin_x, np.append(ys, ys[:1]) + origin_y
+
+def get_measurement_arrays(measurements):
+    # The x, y and area of a list of measurements as arrays.
+    xs = np.array([measurement[0] for measurement in measurements], dtype=float)
+    ys = np.array([measurement[1] for measurement in measurements], dtype=float)
+    areas = np.array([measurement[2] for measurement in measurements], dtype=float)
+    return xs, ys, areas
+
 class CloseMeasurementsPair:
     """
     Class for storing two close measurements and the distance between them
     """
-    def __init__(self, timestamp, measurement1, measurement2,circle):
+    __slots__ = ("timestamp", "measurement_indices", "measurement1", "measurement2", "measurement1_polygon", "measurement2_polygon",
+                 "circle_center", "circle_radius", "areas", "distance_between")
+
+    def __init__(self, timestamp, measurement1, measurement2,circle, measurement_indices=(None, None)):
         self.timestamp = timestamp
+        self.measurement_indices = measurement_indices  # Index of the two measurements in the scan
         self.measurement1 = measurement1[0:2]
         self.measurement2 = measurement2[0:2]
         self.measurement1_polygon = (measurement1[3], measurement1[4])
@@ -29,13 +51,27 @@ class CloseMeasurementsPair:
         temp_str += f"Measurement 2: {self.measurement2}\n"
         temp_str += f"Distance between measurements: {self.distance_between:.2f}\n"
         return temp_str
+
+    def to_dict(self):
+        # The pair as a flat dict of numbers, e.g. for exporting it to a table.
+        return {"timestamp": float(self.timestamp), "index1": self.measurement_indices[0], "index2": self.measurement_indices[1],
+                "x1": float(self.measurement1[0]), "y1": float(self.measurement1[1]),
+                "x2": float(self.measurement2[0]), "y2": float(self.measurement2[1]),
+                "area1": float(self.areas[0]), "area2": float(self.areas[1]), "distance_between": float(self.distance_between),
+                "circle_x": float(self.circle_center[0]), "circle_y": float(self.circle_center[1]), "circle_radius": float(self.circle_radius)}
     
 class MergeMeasurements:
     """
     Class for storing the previous and current measurements that are merged
     """
-    def __init__(self, close_measurement_pair, current_timestamp, current_measurement):
+    __slots__ = ("prev_timestamp", "prev_measurement_indices", "current_index", "prev_measurement1", "prev_measurement2",
+                 "distance_between", "prev_measurement1_polygon", "prev_measurement2_polygon", "area", "current_timestamp",
+                 "current_measurement", "current_measurement_polygon", "current_area", "track_ids")
+
+    def __init__(self, close_measurement_pair, current_timestamp, current_measurement, current_index=None):
         self.prev_timestamp = close_measurement_pair.timestamp
+        self.prev_measurement_indices = close_measurement_pair.measurement_indices
+        self.current_index = current_index  # Index of the current measurement in its scan
         self.prev_measurement1 = close_measurement_pair.measurement1
         self.prev_measurement2 = close_measurement_pair.measurement2
         self.distance_between = close_measurement_pair.distance_between
@@ -47,6 +83,7 @@ class MergeMeasurements:
         self.current_measurement = current_measurement[0:2]
         self.current_measurement_polygon = (current_measurement[3], current_measurement[4])
         self.current_area = current_measurement[2]
+        self.track_ids = None
 
     def __repr__(self) -> str:
         temp_str = f"Previous timestamp: {self.prev_timestamp:.2f}\n"
@@ -63,33 +100,65 @@ class MergeMeasurements:
     def add_track_ids(self, track_ids):
         self.track_ids = track_ids
 
+    def to_dict(self):
+        # The merged measurement as a flat dict of numbers, e.g. for exporting it to a table.
+        track_ids = self.track_ids if self.track_ids is not None else (None, None, None)
+        return {"prev_timestamp": float(self.prev_timestamp),
+                "prev_x1": float(self.prev_measurement1[0]), "prev_y1": float(self.prev_measurement1[1]),
+                "prev_x2": float(self.prev_measurement2[0]), "prev_y2": float(self.prev_measurement2[1]),
+                "prev_area1": float(self.area[0]), "prev_area2": float(self.area[1]),
+                "prev_index1": self.prev_measurement_indices[0], "prev_index2": self.prev_measurement_indices[1],
+                "distance_between": float(self.distance_between), "current_timestamp": float(self.current_timestamp),
+                "current_x": float(self.current_measurement[0]), "current_y": float(self.current_measurement[1]),
+                "current_area": float(self.current_area), "current_index": self.current_index,
+                "track_id1": track_ids[0], "track_id2": track_ids[1], "current_track_id": track_ids[2]}
+
     def plot_MM_init(self, ax, origin_x=0, origin_y=0):
         ax.scatter(self.prev_measurement1[0] + origin_x, self.prev_measurement1[1] + origin_y, c="#1f77b4", zorder=10, label='Close measurement pair')
         ax.scatter(self.prev_measurement2[0] + origin_x, self.prev_measurement2[1] + origin_y, c='#1f77b4', zorder=10)
-        ax.plot(np.array(self.prev_measurement1_polygon[0]) + origin_x, np.array(self.prev_measurement1_polygon[1]) + origin_y, c='#1f77b4',linewidth=3, zorder=9, label='Close measurement pair cluster area')
-        ax.plot(np.array(self.prev_measurement2_polygon[0]) + origin_x, np.array(self.prev_measurement2_polygon[1]) + origin_y, c='#1f77b4',linewidth=3, zorder=9)
+        ax.plot(*get_closed_polygon(self.prev_measurement1_polygon, origin_x, origin_y), c='#1f77b4',linewidth=3, zorder=9, label='Close measurement pair cluster area')
+        ax.plot(*get_closed_polygon(self.prev_measurement2_polygon, origin_x, origin_y), c='#1f77b4',linewidth=3, zorder=9)
         ax.scatter(self.current_measurement[0] + origin_x, self.current_measurement[1] + origin_y, c='#ff7f0e', zorder=10, label='Merged measurement')
-        ax.plot(np.array(self.current_measurement_polygon[0]) + origin_x, np.array(self.current_measurement_polygon[1]) + origin_y, c='#ff7f0e',linewidth=3, zorder=8, label='Merged measurement cluster area')
+        ax.plot(*get_closed_polygon(self.current_measurement_polygon, origin_x, origin_y), c='#ff7f0e',linewidth=3, zorder=8, label='Merged measurement cluster area')
 
 
     def plot_MM_update(self, ax, origin_x=0, origin_y=0):
         ax.scatter(self.prev_measurement1[0] + origin_x, self.prev_measurement1[1] + origin_y, c='#1f77b4', zorder=10)
         ax.scatter(self.prev_measurement2[0] + origin_x, self.prev_measurement2[1] + origin_y, c='#1f77b4', zorder=10)
         ax.scatter(self.current_measurement[0] + origin_x, self.current_measurement[1] + origin_y, c='#ff7f0e', zorder=10)
-        ax.plot(np.array(self.current_measurement_polygon[0]) + origin_x, np.array(self.current_measurement_polygon[1]) + origin_y, c='#ff7f0e',linewidth=2, zorder=10)
+        ax.plot(*get_closed_polygon(self.current_measurement_polygon, origin_x, origin_y), c='#ff7f0e',linewidth=2, zorder=10)
      
 class ComputeMergeMeasurements:
-    def __init__(self, measurement_dict, filename):
+    """
+    Class for finding merged measurements. The measurement_dict can either be a dict from timestamp to a list of
+    measurements, or a MeasurementFrame, whose columns are then read directly instead of making lists of the measurements.
+    """
+    def __init__(self, measurement_dict, filename, expired_track_lifetime=None):
         self.measurement_dict = measurement_dict
         self.filename = filename
+        # Print the progress of the detection, which tools running the detection many times can turn off.
+        self.verbose = True
+
+        # Ordered index of the timestamps, used for looking up the scans before and after a timestamp.
+        self.timestamps = list(self.measurement_dict.keys())
+        self.timestamp_positions = {}
+        for position, timestamp in enumerate(self.timestamps):
+            self.timestamp_positions.setdefault(timestamp, position)
 
         # Parameters for determining close measurements and measurement area thresholds.
         self.distance_between_measurements = 20
         self.measurement_area_threshold = 5
+        # Number of scans after a close measurement pair that are checked for the merged measurement.
+        self.number_of_scans_to_look_ahead = 1
 
         # Parameters for tracking, including distance and time between consecutive measurements in a track.
         self.distance_between_measurements_in_track = 15
         self.time_between_measurements_in_track = 4
+        # Time that tracks are kept after their last measurement, see utilities.Tracker. None keeps them for the whole file,
+        # which gives the original tracks, but the tracking gets slower with the square of the length of the file.
+        # A lifetime, e.g. time_between_measurements_in_track, keeps the tracking linear, but can change the tracks, since
+        # a measurement close to a removed track can then extend another track instead of starting a new one.
+        self.expired_track_lifetime = expired_track_lifetime
         self.tracks = self.establish_tracks()  # Initializes tracks based on the measurements.
 
         # Lists for storing information about measurements that are close and potentially merged.
@@ -97,6 +166,26 @@ class ComputeMergeMeasurements:
         self.merged_measurements = []
         self.new_merged_measurements = []
 
+    def get_parameters(self):
+        # The parameters that decide which merged measurements are found, e.g. for recording them with the results.
+        return {"distance_between_measurements": self.distance_between_measurements,
+                "measurement_area_threshold": self.measurement_area_threshold,
+                "number_of_scans_to_look_ahead": self.number_of_scans_to_look_ahead,
+                "distance_between_measurements_in_track": self.distance_between_measurements_in_track,
+                "time_between_measurements_in_track": self.time_between_measurements_in_track,
+                "expired_track_lifetime": self.expired_track_lifetime}
+
+    @classmethod
+    def from_scans(cls, scans, filename, expired_track_lifetime=None):
+        """
+        Creates the object from an iterable of (timestamp, measurements), e.g. import_data_from_json.iterate_scans,
+        such that only the measurements are kept in memory and not the whole rosbag file
+        """
+        measurement_dict = {}
+        for timestamp, measurements in scans:
+            measurement_dict[timestamp] = measurements
+        return cls(measurement_dict, filename, expired_track_lifetime)
+
     def get_circle(self, point1, point2):
         # Calculate the center and radius of a circle that encompasses two points.
         center_x, center_y = ((point1[0] + point2[0]) / 2, (point1[1] + point2[1]) / 2)
@@ -104,15 +193,61 @@ class ComputeMergeMeasurements:
         center = (center_x, center_y)
         return (center, radius)
 
-    def get_next_key_in_measurement_dict(self, current_key):
-        # Find the next key in the measurement dictionary, if any, following the current key.
-        d = self.measurement_dict
-        keys = list(d.keys())
-        try:
-            current_index = keys.index(current_key)
-            return keys[current_index + 1]  # Return the next key.
-        except (ValueError, IndexError):
-            return None  # Return None if current_key is the last key or not found.
+    def get_close_pairs(self, measurements):
+        """
+        Returns the index pairs (i, j), i < j, of the measurements in a scan that are closer than distance_between_measurements,
+        and where both areas are above measurement_area_threshold
+        """
+        return self.get_close_pairs_of_arrays(*get_measurement_arrays(measurements))
+
+    def get_close_pairs_of_arrays(self, xs, ys, areas):
+        # Same as get_close_pairs, for the x, y and area of the measurements in a scan as arrays.
+        if len(xs) < 2:
+            return []
+        # Only measurements with a large enough area can be part of a pair
+        candidates = np.flatnonzero(areas > self.measurement_area_threshold)
+        i, j = find_close_pairs(xs[candidates], ys[candidates], self.distance_between_measurements)
+        return list(zip(candidates[i].tolist(), candidates[j].tolist()))
+
+    def get_key_at_offset(self, current_key, offset):
+        # Find the key in the measurement dictionary that is offset positions away from the current key.
+        current_index = self.timestamp_positions.get(current_key)
+        if current_index is None:
+            return None  # Return None if current_key is not found.
+        index = current_index + offset
+        if index < 0 or index >= len(self.timestamps):
+            return None  # Return None if there is no key at the offset.
+        return self.timestamps[index]
+
+    def get_next_key_in_measurement_dict(self, current_key, steps=1):
+        # Find the key steps positions after the current key, if any.
+        return self.get_key_at_offset(current_key, steps)
+
+    def get_previous_key_in_measurement_dict(self, current_key, steps=1):
+        # Find the key steps positions before the current key, if any.
+        return self.get_key_at_offset(current_key, -steps)
+
+    def get_scan_arrays(self, timestamp):
+        # The x, y and area of the measurements in the scan at timestamp, as views into the columns of a MeasurementFrame.
+        if isinstance(self.measurement_dict, MeasurementFrame):
+            scan_slice = self.measurement_dict.scan_slice(self.measurement_dict.scan_index[timestamp])
+            return self.measurement_dict.x[scan_slice], self.measurement_dict.y[scan_slice], self.measurement_dict.area[scan_slice]
+        return get_measurement_arrays(self.measurement_dict[timestamp])
+
+    def get_measurement(self, timestamp, index):
+        # The measurement at index in the scan at timestamp, as [x, y, area, polygon_xs, polygon_ys].
+        if isinstance(self.measurement_dict, MeasurementFrame):
+            scan_slice = self.measurement_dict.scan_slice(self.measurement_dict.scan_index[timestamp])
+            return self.measurement_dict.get_measurement(scan_slice.start + index)
+        return self.measurement_dict[timestamp][index]
+
+    def get_measurements(self, timestamp, indices):
+        # The measurements at indices in the scan at timestamp, as a dict from index to measurement.
+        if isinstance(self.measurement_dict, MeasurementFrame):
+            scan_slice = self.measurement_dict.scan_slice(self.measurement_dict.scan_index[timestamp])
+            return dict(zip(indices, self.measurement_dict.get_measurements(np.asarray(indices, dtype=np.int64) + scan_slice.start)))
+        measurements = self.measurement_dict[timestamp]
+        return {index: measurements[index] for index in indices}
 
     def check_next_measurement(self, next_timestamp, close_measurement_object):
         # Check if the next measurement at next_timestamp should be considered as merged with the current one.
@@ -121,7 +256,7 @@ class ComputeMergeMeasurements:
         next_measurements_to_plot = []
         if next_timestamp is not None:
             next_measurements = self.measurement_dict[next_timestamp]
-            for next_measurement in next_measurements:
+            for next_index, next_measurement in enumerate(next_measurements):
                 # Check if the there are multiple measurements inside an extended circle around the current measurement.
                 if euclidean_distance(next_measurement, close_measurement_object.circle_center) < close_measurement_object.circle_radius * 2:
                     next_measurements_to_plot.append(next_measurement)
@@ -129,84 +264,125 @@ class ComputeMergeMeasurements:
                 if euclidean_distance(next_measurement, close_measurement_object.circle_center) < close_measurement_object.circle_radius:
                     if next_measurement[2] > (close_measurement_object.areas[0] + close_measurement_object.areas[1]):
                         number_of_merged_measurements_at_next_timestamp += 1
-                        merge_measurements = MergeMeasurements(close_measurement_object, next_timestamp, next_measurement)
+                        merge_measurements = MergeMeasurements(close_measurement_object, next_timestamp, next_measurement, next_index)
         
         # Decide whether to add the merge_measurements to the list of merged measurements or not.
         # There should only be one merged measurement at the next timestamp, and it should inside the circle.
         if merge_measurements is not None and len(next_measurements_to_plot) > 1:
-            print("Maybe not merged measurement after all, since there are more than one measurement close to the circle")
+            if self.verbose:
+                print("Maybe not merged measurement after all, since there are more than one measurement close to the circle")
+            instrumentation.count("rejected_by_neighbours")
         elif merge_measurements is None:
             # If no merge is necessary, no action is taken.
             pass
         else:
             # We only have one measurement in the area, and it is considered merged.
             self.merged_measurements.append(merge_measurements)
+            instrumentation.count("candidates")
+            return True
+        return False
+
+    def find_merge_measurements(self, next_timestamp, close_measurement_objects):
+        """
+        Batched version of check_next_measurement, which checks all the close measurement pairs against the scan at
+        next_timestamp at once. Returns the MergeMeasurements of each pair, or None if the pair is not merged,
+        without adding them to merged_measurements.
+        """
+        merge_measurements = [None] * len(close_measurement_objects)
+        if next_timestamp is None or len(close_measurement_objects) == 0:
+            return merge_measurements
+        xs, ys, areas = self.get_scan_arrays(next_timestamp)
+        if len(xs) == 0:
+            return merge_measurements
+        centers = np.array([close_measurement_object.circle_center for close_measurement_object in close_measurement_objects], dtype=float)
+        radii = np.array([close_measurement_object.circle_radius for close_measurement_object in close_measurement_objects], dtype=float)
+        area_sums = np.array([close_measurement_object.areas[0] + close_measurement_object.areas[1]
+                              for close_measurement_object in close_measurement_objects], dtype=float)
+
+        # Distance from each circle center (rows) to each measurement in the next scan (columns)
+        distances = np.sqrt((xs - centers[:, 0:1]) ** 2 + (ys - centers[:, 1:2]) ** 2)
+        crowded = np.count_nonzero(distances < radii[:, None] * 2, axis=1) > 1
+        inside = (distances < radii[:, None]) & (areas > area_sums[:, None])
+        # As in check_next_measurement, the last measurement inside the circle is the merged measurement
+        last_inside = len(xs) - 1 - np.argmax(inside[:, ::-1], axis=1)
+        for k in np.flatnonzero(inside.any(axis=1)).tolist():
+            if crowded[k]:
+                if self.verbose:
+                    print("Maybe not merged measurement after all, since there are more than one measurement close to the circle")
+                instrumentation.count("rejected_by_neighbours")
+            else:
+                next_index = int(last_inside[k])
+                merge_measurements[k] = MergeMeasurements(close_measurement_objects[k], next_timestamp,
+                                                          self.get_measurement(next_timestamp, next_index), next_index)
+        return merge_measurements
+
+    def find_close_measurements(self):
+        """
+        Returns the close measurement pairs of all the scans, in the order of the scans
+        """
+        close_measurements = []
+        for timestamp in self.timestamps:
+            close_pairs = self.get_close_pairs_of_arrays(*self.get_scan_arrays(timestamp))
+            if len(close_pairs) == 0:
+                continue
+            # Only the measurements that are part of a pair are needed
+            measurements = self.get_measurements(timestamp, sorted(set(index for close_pair in close_pairs for index in close_pair)))
+            for i, j in close_pairs:
+                circle = self.get_circle(measurements[i], measurements[j])
+                close_measurements.append(CloseMeasurementsPair(timestamp, measurements[i], measurements[j],circle, (i, j)))
+        return close_measurements
+
+    def find_merge_measurements_for_pairs(self, close_measurements):
+        """
+        Returns the MergeMeasurements of each close measurement pair, or None if no merge is found in the
+        number_of_scans_to_look_ahead scans after the pair. The pairs of a scan are checked against the following scans together.
+        """
+        merge_measurements = []
+        for timestamp, close_measurement_objects in groupby(close_measurements, key=lambda pair: pair.timestamp):
+            close_measurement_objects = list(close_measurement_objects)
+            merge_measurements_of_scan = [None] * len(close_measurement_objects)
+            pending = list(range(len(close_measurement_objects)))
+            # The merged measurement can show up some scans late, so the following scans are checked until a merge is found.
+            for steps in range(1, self.number_of_scans_to_look_ahead + 1):
+                next_timestamp = self.get_next_key_in_measurement_dict(timestamp, steps)
+                if next_timestamp is None:
+                    break
+                found = self.find_merge_measurements(next_timestamp, [close_measurement_objects[k] for k in pending])
+                for k, merge_measurement in zip(pending, found):
+                    merge_measurements_of_scan[k] = merge_measurement
+                pending = [k for k, merge_measurement in zip(pending, found) if merge_measurement is None]
+                if len(pending) == 0:
+                    break
+            merge_measurements += merge_measurements_of_scan
+        return merge_measurements
+
+    def add_merge_measurements(self, merge_measurements):
+        # Add the merged measurements found by find_merge_measurements, skipping the pairs that were not merged.
+        for merge_measurement in merge_measurements:
+            if merge_measurement is not None:
+                self.merged_measurements.append(merge_measurement)
+                instrumentation.count("candidates")
 
     def establish_tracks(self):
         """
         Used to establish "tracks", which are used to filter out noise
         """
         # Establish tracks from the measurements by linking measurements that are close in space and time.
-        tracks = []
-        track_counter = 0
-        for timestamp, measurements in self.measurement_dict.items():
-            if not tracks:
-                # Initialize tracks with the first set of measurements if tracks list is empty.
-                for measurement in measurements:
-                    track = Track(track_counter)
-                    track.add_measurement(timestamp, measurement[0], measurement[1])
-                    tracks.append(track)
-                    track_counter += 1
-                continue
-
-            # For subsequent measurements, attempt to add them to existing tracks based on proximity criteria.
-            for measurement in measurements:
-                distances_to_last = []
-                distance_to_second_last = []
-                y = measurement[0]
-                x = measurement[1]
-                for track in tracks:
-                    # Calculate distances from the measurement to the last and second-last points in each track.
-                    distance_to_track = euclidean_distance((track.measurements[-1]['x'], track.measurements[-1]['y']), (x, y))
-                    distances_to_last.append(distance_to_track)
-                    if len(track.measurements) > 1:
-                        distance_to_second_last.append(euclidean_distance((track.measurements[-2]['x'], track.measurements[-2]['y']), (x, y)))
-                    else:
-                        distance_to_second_last.append(1000)  # Arbitrary large distance if no second-last measurement.
-
-                # Decide whether to add the measurement to an existing track or start a new one based on the distances and time.
-                if min(distances_to_last) < self.distance_between_measurements_in_track:
-                    track_index = distances_to_last.index(min(distances_to_last))
-                    last_timestamp = tracks[track_index].measurements[-1]['timestamp']
-                    # If the time gap is small enough, add the measurement to the track.
-                    if timestamp - last_timestamp < self.time_between_measurements_in_track:
-                        tracks[track_index].add_measurement(timestamp, x, y)
-                    else:
-                        # If the time gap is too large, start a new track.
-                        track = Track(track_counter)
-                        track.add_measurement(timestamp, x, y)
-                        tracks.append(track)
-                        track_counter += 1
-
-                elif min(distance_to_second_last) < self.distance_between_measurements_in_track:
-                    # Similar logic for second-last measurements.
-                    track_index = distance_to_second_last.index(min(distance_to_second_last))
-                    last_timestamp = tracks[track_index].measurements[-1]['timestamp']
-                    if timestamp - last_timestamp < self.time_between_measurements_in_track:
-                        tracks[track_index].add_measurement(timestamp, x, y)
-                    else:
-                        track = Track(track_counter)
-                        track.add_measurement(timestamp, x, y)
-                        tracks.append(track)
-                        track_counter += 1
-                
+        tracker = Tracker(self.distance_between_measurements_in_track, self.time_between_measurements_in_track,
+                          expired_track_lifetime=self.expired_track_lifetime)
+        # The track id of each measurement, stored per timestamp in the same order as the measurements in the scan.
+        self.measurement_track_ids = {}
+        with instrumentation.stage("tracking"):
+            for timestamp in self.timestamps:
+                if isinstance(self.measurement_dict, MeasurementFrame):
+                    # Only the x and y of the measurements are used by the tracker
+                    xs, ys, _ = self.get_scan_arrays(timestamp)
+                    measurements = list(zip(xs.tolist(), ys.tolist()))
                 else:
-                    # If no existing track is suitable, start a new track.
-                    track = Track(track_counter)
-                    track.add_measurement(timestamp, x, y)
-                    tracks.append(track)
-                    track_counter += 1
-        return tracks  # Return the list of established tracks.
+                    measurements = self.measurement_dict[timestamp]
+                self.measurement_track_ids[timestamp] = tracker.add_scan(timestamp, measurements)
+        instrumentation.count("tracks", len(tracker.tracks))
+        return list(tracker.tracks.values())  # Return the list of established tracks.
 
     def check_tracks_for_same_measurement(self):
         """
@@ -217,24 +393,25 @@ class ComputeMergeMeasurements:
         """
         new_merged_measurements = []
         for merged_measurement in self.merged_measurements:
-            track_id_of_current_measurement = None
-            track_id_of_prev_measurement1 = None
-            track_id_of_prev_measurement2 = None
-            for track in self.tracks:
-                # Identify the tracks of the current and previous measurements involved in a merge.
-                for measurement in track.measurements:
-                    if measurement['y'] == merged_measurement.current_measurement[0] and measurement['x'] == merged_measurement.current_measurement[1]:
-                        track_id_of_current_measurement = track.track_id
-                    elif measurement['y'] == merged_measurement.prev_measurement1[0] and measurement['x'] == merged_measurement.prev_measurement1[1]:
-                        track_id_of_prev_measurement1 = track.track_id
-                    elif measurement['y'] == merged_measurement.prev_measurement2[0] and measurement['x'] == merged_measurement.prev_measurement2[1]:
-                        track_id_of_prev_measurement2 = track.track_id
+            # Identify the tracks of the current and previous measurements involved in a merge.
+            track_id_of_current_measurement = self.get_track_id(merged_measurement.current_timestamp, merged_measurement.current_index)
+            track_id_of_prev_measurement1 = self.get_track_id(merged_measurement.prev_timestamp, merged_measurement.prev_measurement_indices[0])
+            track_id_of_prev_measurement2 = self.get_track_id(merged_measurement.prev_timestamp, merged_measurement.prev_measurement_indices[1])
+            merged_measurement.add_track_ids((track_id_of_prev_measurement1, track_id_of_prev_measurement2, track_id_of_current_measurement))
 
             # If the current and previous measurements are from different tracks, consider them truly merged.
             if track_id_of_current_measurement != track_id_of_prev_measurement1 or track_id_of_current_measurement != track_id_of_prev_measurement2:
                 new_merged_measurements.append(merged_measurement)
+        instrumentation.count("rejected_by_track", len(self.merged_measurements) - len(new_merged_measurements))
+        instrumentation.count("merged_measurements", len(new_merged_measurements))
         self.new_merged_measurements = new_merged_measurements
 
+    def get_track_id(self, timestamp, index):
+        # Look up the track id of the measurement at index in the scan at timestamp.
+        if index is None:
+            return None
+        return self.measurement_track_ids[timestamp][index]
+
 
     def check_for_merge_measurements(self):
         """
@@ -242,22 +419,67 @@ class ComputeMergeMeasurements:
         First establishes close measurements, then checks if the next measurement is also close to the circle around the current
         measurement. If it is, the two measurements are considered merged.
         """
-        for timestamp, measurements in self.measurement_dict.items():
-            for i in range(len(measurements)):
-                for j in range(i+1, len(measurements)):
-                    if euclidean_distance(measurements[i], measurements[j]) < self.distance_between_measurements:
-                        if measurements[i][2] > self.measurement_area_threshold and measurements[j][2] > self.measurement_area_threshold:
-                            circle = self.get_circle(measurements[i], measurements[j])
-                            self.close_measurements.append(CloseMeasurementsPair(timestamp, measurements[i], measurements[j],circle))
+        with instrumentation.stage("pair_search"):
+            self.close_measurements += self.find_close_measurements()
+        instrumentation.count("close_pairs", len(self.close_measurements))
 
         if self.close_measurements == []:
-            print("No close measurements, resulting in no merged measurements")
+            if self.verbose:
+                print("No close measurements, resulting in no merged measurements")
         else:
-            for close_measurement_object in self.close_measurements:
-                timestamp = close_measurement_object.timestamp
-                next_timestamp = self.get_next_key_in_measurement_dict(timestamp)
-                self.check_next_measurement(next_timestamp,close_measurement_object)
+            with instrumentation.stage("merge_check"):
+                self.add_merge_measurements(self.find_merge_measurements_for_pairs(self.close_measurements))
+
+            with instrumentation.stage("track_check"):
+                self.check_tracks_for_same_measurement()
+
+
+class OnlineMergeDetector(ComputeMergeMeasurements):
+    """
+    Detects merged measurements while the scans arrive, e.g. alongside the live radar.
+    Only the scans needed for checking the close measurement pairs, and the tracks that are still active, are kept,
+    such that the memory usage does not grow with the length of the recording.
+    """
+    def __init__(self, filename=None, expired_track_lifetime=600):
+        # Time that expired tracks are kept, since new measurements close to them start new tracks.
+        # None keeps them forever, which gives the same result as ComputeMergeMeasurements, but memory that grows with time.
+        super().__init__({}, filename, expired_track_lifetime)
+        self.tracker = None
+        self.pending_close_measurements = []  # Close measurement pairs and the number of scans left to check
+
+    def push_scan(self, timestamp, measurements):
+        """
+        Adds the measurements of a new scan, and returns the merged measurements confirmed by this scan
+        """
+        if self.tracker is None:
+            # Only the last two measurements of the tracks are used when adding new measurements.
+            self.tracker = Tracker(self.distance_between_measurements_in_track, self.time_between_measurements_in_track,
+                                   expired_track_lifetime=self.expired_track_lifetime, history_length=2)
+        self.measurement_dict[timestamp] = measurements
+        self.measurement_track_ids[timestamp] = self.tracker.add_scan(timestamp, measurements)
+
+        # Check the close measurement pairs of the previous scans against this scan.
+        self.merged_measurements = []
+        pending_close_measurements = []
+        merge_measurements = self.find_merge_measurements(timestamp, [close_measurement_object for close_measurement_object, _ in self.pending_close_measurements])
+        for (close_measurement_object, scans_left), merge_measurement in zip(self.pending_close_measurements, merge_measurements):
+            if merge_measurement is None and scans_left > 1:
+                pending_close_measurements.append((close_measurement_object, scans_left - 1))
+        self.add_merge_measurements(merge_measurements)
+        self.check_tracks_for_same_measurement()
 
-            self.check_tracks_for_same_measurement()       
+        close_pairs = self.get_close_pairs(measurements)
+        instrumentation.count("close_pairs", len(close_pairs))
+        for i, j in close_pairs:
+            circle = self.get_circle(measurements[i], measurements[j])
+            close_measurement_object = CloseMeasurementsPair(timestamp, measurements[i], measurements[j], circle, (i, j))
+            pending_close_measurements.append((close_measurement_object, self.number_of_scans_to_look_ahead))
+        self.pending_close_measurements = pending_close_measurements
 
+        # Only keep the scans that can still be needed by the pending close measurement pairs.
+        while len(self.measurement_dict) > self.number_of_scans_to_look_ahead + 1:
+            oldest_timestamp = next(iter(self.measurement_dict))
+            del self.measurement_dict[oldest_timestamp]
+            del self.measurement_track_ids[oldest_timestamp]
+        return self.new_merged_measurements
 
@@ -0,0 +1,132 @@
+"""
+Description: Evaluates a grid of the parameters of ComputeMergeMeasurements on a file in one process, and prints the
+number of merged measurements for each combination of parameters.
+The file is parsed once. The close measurement pairs are found once, at the largest distance and smallest area threshold,
+and checked for merges once, since a pair is merged or not independent of the other pairs. For each combination the
+pairs are filtered by distance and area, and the tracks are made once for each combination of tracking parameters.
+Example: python parameter_sweep.py rosbag.json --distance 10 15 20 25 30 --area 2 5 8 --track-distance 10 15
+"""
+import argparse
+import csv
+import itertools
+import os
+import numpy as np
+import import_data_from_json
+import merged_measurement
+import utilities
+
+parameter_names = ["distance_between_measurements", "measurement_area_threshold",
+                   "distance_between_measurements_in_track", "time_between_measurements_in_track"]
+
+class ParameterSweep:
+    """
+    Class for evaluating many combinations of parameters on the same measurements
+    """
+    def __init__(self, measurement_dict, filename, expired_track_lifetime=None):
+        self.computer = merged_measurement.ComputeMergeMeasurements(measurement_dict, filename, expired_track_lifetime)
+        # The prints of ComputeMergeMeasurements are not needed for every combination
+        self.computer.verbose = False
+        # The track ids of the measurements for each combination of tracking parameters, starting with the default ones
+        tracking_parameters = (self.computer.distance_between_measurements_in_track, self.computer.time_between_measurements_in_track)
+        self.track_ids = {tracking_parameters: self.computer.measurement_track_ids}
+
+    def get_track_ids(self, distance_between_measurements_in_track, time_between_measurements_in_track):
+        tracking_parameters = (distance_between_measurements_in_track, time_between_measurements_in_track)
+        if tracking_parameters not in self.track_ids:
+            self.computer.distance_between_measurements_in_track = distance_between_measurements_in_track
+            self.computer.time_between_measurements_in_track = time_between_measurements_in_track
+            self.computer.establish_tracks()
+            self.track_ids[tracking_parameters] = self.computer.measurement_track_ids
+        return self.track_ids[tracking_parameters]
+
+    def find_candidate_pairs(self, max_distance, min_area_threshold):
+        """
+        Finds the close measurement pairs at the largest distance and smallest area threshold, and their merges
+        """
+        self.computer.distance_between_measurements = max_distance
+        self.computer.measurement_area_threshold = min_area_threshold
+        close_measurements = self.computer.find_close_measurements()
+        merge_measurements = self.computer.find_merge_measurements_for_pairs(close_measurements)
+        self.pair_distances = np.array([pair.distance_between for pair in close_measurements], dtype=float)
+        self.pair_areas = np.array([min(pair.areas) for pair in close_measurements], dtype=float)
+        # Only the pairs with a merge are needed for counting the merged measurements
+        self.merged_pairs = [(pair, merge_measurement) for pair, merge_measurement in zip(close_measurements, merge_measurements)
+                             if merge_measurement is not None]
+
+    def evaluate(self, distance_between_measurements, measurement_area_threshold,
+                 distance_between_measurements_in_track, time_between_measurements_in_track):
+        """
+        Returns the number of close measurement pairs, merged measurements, and merged measurements that are not
+        removed by the tracks, for one combination of parameters
+        """
+        number_of_close_pairs = np.count_nonzero((self.pair_distances < distance_between_measurements) & (self.pair_areas > measurement_area_threshold))
+        merged_measurements = [merge_measurement for pair, merge_measurement in self.merged_pairs
+                               if pair.distance_between < distance_between_measurements and min(pair.areas) > measurement_area_threshold]
+        self.computer.merged_measurements = merged_measurements
+        self.computer.measurement_track_ids = self.get_track_ids(distance_between_measurements_in_track, time_between_measurements_in_track)
+        self.computer.check_tracks_for_same_measurement()
+        return int(number_of_close_pairs), len(merged_measurements), len(self.computer.new_merged_measurements)
+
+    def run(self, grid):
+        """
+        Evaluates every combination of the parameter values in grid, which maps the parameter names to lists of values.
+        Parameters that are not in grid keep the values of ComputeMergeMeasurements. Returns a row for each combination.
+        """
+        values = [grid.get(name, [getattr(self.computer, name)]) for name in parameter_names]
+        self.find_candidate_pairs(max(values[0]), min(values[1]))
+        rows = []
+        for parameters in itertools.product(*values):
+            number_of_close_pairs, number_of_merged, number_of_new_merged = self.evaluate(*parameters)
+            row = dict(zip(parameter_names, parameters))
+            row["close_pairs"] = number_of_close_pairs
+            row["merged_measurements"] = number_of_merged
+            row["new_merged_measurements"] = number_of_new_merged
+            rows.append(row)
+        return rows
+
+def print_table(rows):
+    columns = list(rows[0].keys())
+    widths = [max(len(column), 8) for column in columns]
+    print("  ".join(column.rjust(width) for column, width in zip(columns, widths)))
+    for row in rows:
+        print("  ".join(str(row[column]).rjust(width) for column, width in zip(columns, widths)))
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate a grid of parameters for finding merged measurements")
+    parser.add_argument("files", nargs="+", help="Rosbag json files")
+    parser.add_argument("--distance", type=float, nargs="+", help="Values of distance_between_measurements")
+    parser.add_argument("--area", type=float, nargs="+", help="Values of measurement_area_threshold")
+    parser.add_argument("--track-distance", type=float, nargs="+", help="Values of distance_between_measurements_in_track")
+    parser.add_argument("--track-time", type=float, nargs="+", help="Values of time_between_measurements_in_track")
+    parser.add_argument("--cache-dir", default=None, help="Directory for caching the parsed files")
+    parser.add_argument("--expired-track-lifetime", type=float, default=None,
+                        help="Time in seconds that tracks are kept after their last measurement. By default they are kept for the whole file, "
+                             "which gives the original results but is slow for long files. A lifetime, e.g. 600, is faster, but changes which "
+                             "merged measurements are removed by the tracks, see expired_track_lifetime in main.py")
+    parser.add_argument("--csv", default=None, help="Also write the table to this csv file")
+    args = parser.parse_args()
+
+    grid = {}
+    for name, values in zip(parameter_names, [args.distance, args.area, args.track_distance, args.track_time]):
+        if values is not None:
+            grid[name] = values
+
+    all_rows = []
+    for file_path in args.files:
+        filename = os.path.basename(file_path)
+        measurement_dict = import_data_from_json.import_data_from_json(file_path, cache_dir=args.cache_dir)
+        measurement_dict.pop('Timestamp')
+        measurement_dict = utilities.filter_out_measurements_outside_area(measurement_dict, utilities.area_vertices)
+        rows = ParameterSweep(measurement_dict, filename, args.expired_track_lifetime).run(grid)
+        print(f"File: {filename}")
+        print_table(rows)
+        all_rows += [dict(file=filename, **row) for row in rows]
+
+    if args.csv is not None:
+        with open(args.csv, 'w', newline='') as file:
+            writer = csv.DictWriter(file, fieldnames=list(all_rows[0].keys()))
+            writer.writeheader()
+            writer.writerows(all_rows)
+
+if __name__ == "__main__":
+    main()
@@ -1,53 +1,68 @@
 import matplotlib.pyplot as plt
 import numpy as np
-from images_to_video import images_to_video_opencv, empty_folder
-import progressbar
-from matplotlib.colors import LinearSegmentedColormap
-import matplotlib.patches as mpatches
+import instrumentation
+from concurrent.futures import ProcessPoolExecutor
+from measurement_frame import MeasurementFrame
+from utilities import get_scan_colors
+from matplotlib.colors import LinearSegmentedColormap, Normalize
+
+# The background of the plots for each work_dir, which is only made once per process
+background_cache = {}
+
+def load_background(work_dir):
+    """
+    Loads the occupancy grids and renders them into one RGB image, which is done once per process and work_dir.
+    The second occupancy grid is blended on top of the first one with alpha 0.2, in the same way as two imshow layers.
+    """
+    if work_dir in background_cache:
+        return background_cache[work_dir]
 
-def plot(work_dir):
-    font_size_axis = 20
-    font_size = 17
-    fig, ax = plt.subplots(figsize=(11, 7.166666))
     data = np.load(f"{work_dir}/npy_files/occupancy_grid.npy",allow_pickle='TRUE').item()
     occupancy_grid = data["occupancy_grid"]
-    origin_x = data["origin_x"]
-    origin_y = data["origin_y"]
     colors = [(1, 1, 1), (0.8, 0.8, 0.8)]  # Black to light gray
     cm = LinearSegmentedColormap.from_list('custom_gray', colors, N=256)
-    ax.imshow(occupancy_grid, cmap=cm, interpolation='none', origin='upper', 
-              extent=[0, occupancy_grid.shape[1], 0, occupancy_grid.shape[0]])
-    
-    # Highlight origin
-    ax.plot(origin_x, origin_y, c="Black", marker="o", zorder=10, markersize=10)
-    ax.annotate(f"Radar", (origin_x + 2, origin_y + 2), zorder=10, fontsize=font_size)
-    
+    image = cm(Normalize(occupancy_grid.min(), occupancy_grid.max())(occupancy_grid))[:, :, :3]
+
     display_second_occupancy_grid = True
     if display_second_occupancy_grid:
-        # Load and display the second occupancy grid
+        # Load the second occupancy grid and blend it with alpha for overlap effect
         data2 = np.load(f"{work_dir}/npy_files/occupancy_grid_without_dilating.npy", allow_pickle=True).item()
         occupancy_grid2 = data2["occupancy_grid"]
-        
-        # Second imshow with alpha for overlap effect
-        ax.imshow(occupancy_grid2, cmap="binary", interpolation='none', origin='upper', 
-                extent=[0, occupancy_grid2.shape[1], 0, occupancy_grid2.shape[0]], alpha=0.2)
-        
-        # Create custom patches for legend
-        first_image_patch = mpatches.Patch(color='gray', label='True land')
-        second_image_patch = mpatches.Patch(color='black', alpha=0.2, label='Land after dilation')
-        
-
-        # Add legend
-        # ax.legend(handles=[first_image_patch, second_image_patch], loc='upper left', fontsize=12)
-        
+        image2 = plt.get_cmap("binary")(Normalize(occupancy_grid2.min(), occupancy_grid2.max())(occupancy_grid2))[:, :, :3]
+        image = 0.2 * image2 + 0.8 * image
+
+    background = {"image": image, "origin_x": data["origin_x"], "origin_y": data["origin_y"], "subplot_params": None}
+    background_cache[work_dir] = background
+    return background
+
+def plot(work_dir):
+    font_size_axis = 20
+    font_size = 17
+    fig, ax = plt.subplots(figsize=(11, 7.166666))
+    background = load_background(work_dir)
+    image = background["image"]
+    origin_x = background["origin_x"]
+    origin_y = background["origin_y"]
+    ax.imshow(image, interpolation='none', origin='upper', extent=[0, image.shape[1], 0, image.shape[0]])
     
+    # Highlight origin
+    ax.plot(origin_x, origin_y, c="Black", marker="o", zorder=10, markersize=10)
+    ax.annotate(f"Radar", (origin_x + 2, origin_y + 2), zorder=10, fontsize=font_size)
+
     ax.set_xlim(origin_x-120,origin_x + 120)
     ax.set_ylim(origin_y-140, origin_y + 20)
     ax.set_aspect('equal')
     ax.set_xlabel('East [m]',fontsize=font_size_axis)
     ax.set_ylabel('North [m]',fontsize=font_size_axis)
     plt.tick_params(axis='both', which='major', labelsize=font_size_axis)
-    plt.tight_layout()
+    # The layout is the same for all the plots, so tight_layout, which draws the figure, is only done for the first plot
+    if background["subplot_params"] is None:
+        plt.tight_layout()
+        subplot_params = fig.subplotpars
+        background["subplot_params"] = {"left": subplot_params.left, "right": subplot_params.right, "bottom": subplot_params.bottom,
+                                        "top": subplot_params.top, "wspace": subplot_params.wspace, "hspace": subplot_params.hspace}
+    else:
+        fig.subplots_adjust(**background["subplot_params"])
 
     # reformating the x and y axis
     x_axis_list = np.arange(origin_x-120,origin_x+121,20)
@@ -80,169 +95,179 @@ def plot_measurements_in_background(measurement_dict,ax,origin_x=0,origin_y=0):
     # ax.set_ylabel('North [m]', fontsize=15)
     # plt.tick_params(axis='both', which='major', labelsize=15)
     # plt.tight_layout()
-    for timestamp, measurements in measurement_dict.items():
-        x = []
-        y = []
-        color = []
-        for measurement in measurements:
-            y.append(measurement[1] + origin_y)
-            x.append(measurement[0] + origin_x)
-            color.append(measurement[5])
-        ax.scatter(x, y, c=color)
-        # ax.set_title(f"Timestamp: {timestamp}")
-    #     plt.pause(0.1)
-    # plt.show()
+    # All the measurements are drawn in one scatter, in the order of the scans, with the color of their scan
+    timestamps, scan_offsets, xs, ys = get_scan_store(measurement_dict)
+    colors = np.repeat(get_scan_colors(timestamps), np.diff(scan_offsets), axis=0)
+    ax.scatter(xs + origin_x, ys + origin_y, c=colors)
+
+class ScanVideoRenderer:
+    """
+    Renders the scans to a video using one figure. For each frame only the measurements of the new scan are drawn,
+    on top of a saved copy of the canvas with the measurements drawn so far. The frames are written directly to the
+    video, without saving images.
+    """
+    def __init__(self, work_dir, video_name, fps=1):
+        # OpenCV is imported when a video is made, such that it is not needed for the report figures
+        import cv2
+        self.fig, self.ax, self.origin_x, self.origin_y = plot(work_dir)
+        self.title = self.ax.set_title("", animated=True)
+        self.fig.canvas.draw()
+        self.background = self.fig.canvas.copy_from_bbox(self.fig.bbox)
+        # The frames are taken from buffer_rgba, which has the size in physical pixels, also on HiDPI screens
+        width, height = self.fig.canvas.get_width_height(physical=True)
+        self.video = cv2.VideoWriter(video_name, cv2.VideoWriter_fourcc(*'DIVX'), fps, (width, height))
+        # Artists of the merged measurements, which are drawn on top of the measurements in every frame
+        self.merged_measurement_artists = []
+
+    def get_new_artists(self, plot_function):
+        # Calls the plot function and returns the artists it added to the axis, which are drawn manually
+        artists_before = set(self.ax.get_children())
+        plot_function(self.ax, self.origin_x, self.origin_y)
+        artists = [artist for artist in self.ax.get_children() if artist not in artists_before]
+        for artist in artists:
+            artist.set_animated(True)
+        return artists
+
+    def add_scan(self, timestamp, measurements, color, new_merged_measurements=()):
+        """
+        Draws the measurements of a scan with the color of the scan, and the merged measurements that start at this scan,
+        and writes the frame
+        """
+        canvas = self.fig.canvas
+        canvas.restore_region(self.background)
+        if len(measurements) > 0:
+            x = [measurement[0] + self.origin_x for measurement in measurements]
+            y = [measurement[1] + self.origin_y for measurement in measurements]
+            points = self.ax.scatter(x, y, c=np.tile(color, (len(measurements), 1)), animated=True)
+            self.ax.draw_artist(points)
+            points.remove()
+            self.background = canvas.copy_from_bbox(self.fig.bbox)
+
+        # Merged measurements are drawn with plot_MM_init in the first frame, and with plot_MM_update after that
+        artists = list(self.merged_measurement_artists)
+        for merged_measurement in new_merged_measurements:
+            artists += self.get_new_artists(merged_measurement.plot_MM_init)
+            self.merged_measurement_artists += self.get_new_artists(merged_measurement.plot_MM_update)
+        for artist in sorted(artists, key=lambda artist: artist.get_zorder()):
+            self.ax.draw_artist(artist)
+        self.title.set_text(f"Timestamp: {timestamp}")
+        self.ax.draw_artist(self.title)
+        canvas.blit(self.fig.bbox)
+
+        import cv2
+        frame = np.asarray(canvas.buffer_rgba())
+        self.video.write(cv2.cvtColor(frame, cv2.COLOR_RGBA2BGR))
+        instrumentation.count("video_frames")
+
+    def close(self):
+        self.video.release()
+        plt.close(self.fig)
 
 def plot_for_vizualization(merged_measurements, measurement_dict, filename, work_dir):
+    import progressbar
     bar = progressbar.ProgressBar(maxval=len(measurement_dict)).start()
 
-    merged_measurements = sorted(merged_measurements, key=lambda x: x.prev_timestamp)
-    merged_measurements_timestamps = []
-    merged_measurements_timestamps_current = []
-    for merged_measurement in merged_measurements:
-        merged_timestamp = merged_measurement.prev_timestamp
-        if merged_timestamp not in merged_measurements_timestamps:
-            merged_measurements_timestamps.append(merged_timestamp)
-        merged_timestamp_current = merged_measurement.current_timestamp
-        if merged_timestamp_current not in merged_measurements_timestamps_current:
-            merged_measurements_timestamps_current.append(merged_timestamp_current)
-
-    x = []
-    y = []
-    color = []
-    
-    merged_measurements_already_plotted = []
-    merged_measurements_index = 0
-    for k, (timestamp, measurements) in enumerate(measurement_dict.items()):
-        merged_measurements_to_plot = []
-        fig, ax, origin_x, origin_y = plot(work_dir)
-        ax.set_title(f"Timestamp: {timestamp}")
-
-        if timestamp < merged_measurements_timestamps[merged_measurements_index]:
-            for measurement in measurements:
-                x.append(measurement[0] + origin_x)
-                y.append(measurement[1] + origin_y)
-                color.append(measurement[5])
-
-        elif timestamp == merged_measurements_timestamps[merged_measurements_index]:
-            for measurement in measurements:
-                x.append(measurement[0] + origin_x) 
-                y.append(measurement[1] + origin_y)
-                color.append(measurement[5])
-            for merged_measurement in merged_measurements:
-                if merged_measurement.prev_timestamp == timestamp:
-                    merged_measurements_to_plot.append(merged_measurement)
-
-        elif timestamp == merged_measurements_timestamps_current[merged_measurements_index]:
-            for measurement in measurements:
-                x.append(measurement[0] + origin_x)
-                y.append(measurement[1] + origin_y)
-                color.append(measurement[5])
-            if merged_measurements_index < len(merged_measurements_timestamps)-1:
-                merged_measurements_index += 1
+    # The merged measurements are shown from the timestamp of the close measurement pair
+    merged_measurements_by_timestamp = {}
+    for merged_measurement in sorted(merged_measurements, key=lambda x: x.prev_timestamp):
+        merged_measurements_by_timestamp.setdefault(merged_measurement.prev_timestamp, []).append(merged_measurement)
 
-        else:
-            for measurement in measurements:
-                y.append(measurement[1] + origin_y)
-                x.append(measurement[0] + origin_x)
-                color.append(measurement[5])
-
-        ax.scatter(x, y, c=color)
-        for merged_measurement in merged_measurements_already_plotted:
-            merged_measurement.plot_MM_update(ax, origin_x, origin_y)
-        for merged_measurement in merged_measurements_to_plot:
-            merged_measurement.plot_MM_init(ax, origin_x, origin_y)
-            merged_measurements_already_plotted.append(merged_measurement)
-        
-        plt.savefig(f"{work_dir}/videos/temp/image_{k}.png")
-        plt.close()
-        bar.update(k)
-
-    # Saving the video
-    photos_file_path = f"{work_dir}/videos/temp"
     video_name = f'{work_dir}/videos/{filename[:-5]}.avi'
-    images_to_video_opencv(photos_file_path, video_name, 1)
+    renderer = ScanVideoRenderer(work_dir, video_name, 1)
+    scan_colors = get_scan_colors(list(measurement_dict.keys()))
+    with instrumentation.stage("video"):
+        for k, (timestamp, measurements) in enumerate(measurement_dict.items()):
+            renderer.add_scan(timestamp, measurements, scan_colors[k], merged_measurements_by_timestamp.get(timestamp, []))
+            bar.update(k)
+        renderer.close()
     print(f"\nSaving the video to {video_name}")
-    # plt.close()
-    empty_folder(photos_file_path)
 
 def plot_for_vizualization_without_merged_measurements(measurement_dict, filename, work_dir):
-
+    import progressbar
     bar = progressbar.ProgressBar(maxval=len(measurement_dict)).start()
 
-    x = []
-    y = []
-    color = []
-    
-    for k, (timestamp, measurements) in enumerate(measurement_dict.items()):
-        fig, ax, origin_x, origin_y = plot(work_dir)
-        ax.set_title(f"Timestamp: {timestamp}")
-        for measurement in measurements:
-            y.append(measurement[1] + origin_y)
-            x.append(measurement[0] + origin_x)
-            color.append(measurement[5])
-        ax.scatter(x, y, c=color)
-        plt.savefig(f"{work_dir}/videos/temp/image_{k}.png")
-        plt.close()
-        bar.update(k)
-
-    # Saving the video
-    photos_file_path = f"{work_dir}/videos/temp"
     video_name = f'{work_dir}/videos/{filename[:-5]}.avi'
-    images_to_video_opencv(photos_file_path, video_name, 1)
+    renderer = ScanVideoRenderer(work_dir, video_name, 1)
+    scan_colors = get_scan_colors(list(measurement_dict.keys()))
+    with instrumentation.stage("video"):
+        for k, (timestamp, measurements) in enumerate(measurement_dict.items()):
+            renderer.add_scan(timestamp, measurements, scan_colors[k])
+            bar.update(k)
+        renderer.close()
     print(f"\nSaving the video to {video_name}")
-    # plt.close()
-    empty_folder(photos_file_path)
 
-def plot_for_report(measurement_dict, merged_measurements, save_dir, filename, work_dir):
-    font_size_axis = 20
+def get_scan_store(measurement_dict):
+    """
+    Returns the timestamps, the scan offsets and the x and y of all the measurements as arrays, where the measurements
+    of scan i are found between scan_offsets[i] and scan_offsets[i+1]
+    """
+    if isinstance(measurement_dict, MeasurementFrame):
+        return measurement_dict.timestamps, measurement_dict.scan_offsets, measurement_dict.x, measurement_dict.y
+    timestamps = np.array(list(measurement_dict.keys()), dtype=float)
+    scan_offsets = np.concatenate(([0], np.cumsum([len(measurements) for measurements in measurement_dict.values()]))).astype(np.int64)
+    xs = np.array([measurement[0] for measurements in measurement_dict.values() for measurement in measurements], dtype=float)
+    ys = np.array([measurement[1] for measurements in measurement_dict.values() for measurement in measurements], dtype=float)
+    return timestamps, scan_offsets, xs, ys
+
+def get_measurements_for_report(scan_store, timestamp_index):
+    """
+    Returns the x, y and color value of the measurements in the 30 scans before and 10 scans after timestamp_index.
+    The color value of a measurement is the timestamp of its scan, spread evenly over the scans in the window.
+    """
+    timestamps, scan_offsets, xs, ys = scan_store
+    first_index = max(timestamp_index - 30, 0)
+    last_index = min(timestamp_index + 10, len(timestamps))
+    start, end = scan_offsets[first_index], scan_offsets[last_index]
+    color_scale = np.linspace(timestamps[first_index], timestamps[last_index-1], last_index - first_index)
+    colors = np.repeat(color_scale, np.diff(scan_offsets[first_index:last_index+1]))
+    return xs[start:end], ys[start:end], colors
+
+def plot_merged_measurement_for_report(x, y, colors, merged_measurement, save_path, work_dir):
     font_size = 17
-    timestamps = list(measurement_dict.keys())
-    k = 0
-    for k, merged_measurement in enumerate(merged_measurements):
-        
-        measurement_dict_for_plotting = {}
-        start_timestamp = merged_measurement.prev_timestamp
-        timestamp_index = timestamps.index(start_timestamp)
-        for i in range(timestamp_index-30,timestamp_index+10):
-            try:
-                timestamp = timestamps[i]
-            except:
-                continue
-            if timestamp not in measurement_dict_for_plotting:
-                measurement_dict_for_plotting[timestamp] = []
-            for measurement in measurement_dict[timestamp]:
-                measurement_dict_for_plotting[timestamp].append([measurement[0], measurement[1]])
-            
-        measurement_dict_for_plotting = dict(sorted(measurement_dict_for_plotting.items()))
-
-        # Determine color scaling based on timestamps
-        timestamps_list = list(measurement_dict_for_plotting.keys())
-        color_scale = np.linspace(timestamps_list[0], timestamps_list[-1], len(timestamps_list))
-
-        fig, ax, origin_x, origin_y = plot(work_dir)
-        
-        x = []
-        y = []
-        colors = []
-        for timestamp, measurements in measurement_dict_for_plotting.items():
-            for measurement in measurements:
-                x.append(measurement[0]+origin_x)
-                y.append(measurement[1]+origin_y)
-                colors.append(color_scale[timestamps_list.index(timestamp)])
-        sc = ax.scatter(x, y, c=colors, cmap='Greys')
-        merged_measurement.plot_MM_init(ax, origin_x, origin_y)
-        ax.legend(loc='lower right', fontsize=font_size)
-        plt.savefig(f"{save_dir}/{filename[:-5]}_merged_measurement_number_{k+1}.png")
-        plt.close()
-    print(f"Saved {k+1} plots to {save_dir}")
+    fig, ax, origin_x, origin_y = plot(work_dir)
+    sc = ax.scatter(x + origin_x, y + origin_y, c=colors, cmap='Greys')
+    merged_measurement.plot_MM_init(ax, origin_x, origin_y)
+    ax.legend(loc='lower right', fontsize=font_size)
+    plt.savefig(save_path)
+    plt.close()
 
+def plot_all_merged_measurements(measurement_dict, merged_measurements, save_path, work_dir):
     fig, ax, origin_x, origin_y = plot(work_dir)
     plot_measurements_in_background(measurement_dict, ax, origin_x, origin_y)
     for merged_measurement in merged_measurements:
         merged_measurement.plot_MM_init(ax, origin_x, origin_y)
-    plt.savefig(f"{save_dir}/{filename[:-5]}_all_merged_measurements.png",dpi=100)
+    plt.savefig(save_path,dpi=100)
     plt.close()
-    
 
+def use_agg_backend():
+    # The processes rendering the figures only write files, so they do not need an interactive backend
+    plt.switch_backend('Agg')
 
+def plot_for_report(measurement_dict, merged_measurements, save_dir, filename, work_dir, number_of_workers=1):
+    """
+    Plots each merged measurement with the scans around it, and all the merged measurements on top of all the scans.
+    With number_of_workers larger than 1, the figures are rendered in parallel processes using the Agg backend.
+    """
+    scan_store = get_scan_store(measurement_dict)
+    timestamp_positions = {timestamp: i for i, timestamp in enumerate(scan_store[0].tolist())}
+    figures = []
+    for k, merged_measurement in enumerate(merged_measurements):
+        x, y, colors = get_measurements_for_report(scan_store, timestamp_positions[merged_measurement.prev_timestamp])
+        save_path = f"{save_dir}/{filename[:-5]}_merged_measurement_number_{k+1}.png"
+        figures.append((plot_merged_measurement_for_report, (x, y, colors, merged_measurement, save_path, work_dir)))
+    save_path = f"{save_dir}/{filename[:-5]}_all_merged_measurements.png"
+    figures.append((plot_all_merged_measurements, (measurement_dict, merged_measurements, save_path, work_dir)))
+
+    with instrumentation.stage("plotting"):
+        if number_of_workers == 1:
+            for plot_function, arguments in figures:
+                plot_function(*arguments)
+        else:
+            # The overview is the slowest figure, so it is started first
+            with ProcessPoolExecutor(max_workers=number_of_workers, initializer=use_agg_backend) as executor:
+                futures = [executor.submit(plot_function, *arguments) for plot_function, arguments in reversed(figures)]
+                for future in futures:
+                    future.result()
+    # The figures are counted here, since they can be written by other processes
+    instrumentation.count("figures_written", len(figures))
+    print(f"Saved {len(merged_measurements)} plots to {save_dir}")
@@ -0,0 +1,102 @@
+"""
+Description: Generates synthetic radar data in the same json format as the rosbag files, such that the code can be
+tested and benchmarked without the real radar data.
+"""
+import json
+import math
+import random
+from utilities import area_vertices, point_inside_polygon
+
+# The area where the targets are placed
+vertices = area_vertices
+
+def random_position(rng):
+    # Draws a random position inside the area
+    while True:
+        x = rng.uniform(-105, 100)
+        y = rng.uniform(-120, 0)
+        if point_inside_polygon((x, y), vertices):
+            return x, y
+
+def make_cluster(rng, x, y, area, cluster_type=3):
+    """
+    Makes a cluster in the rosbag format, with a hull polygon around the centroid with approximately the given area.
+    The rosbag files have x and y swapped compared to the plots, which is done here as well.
+    """
+    radius = math.sqrt(area / math.pi)
+    number_of_points = rng.randint(5, 10)
+    points = []
+    for i in range(number_of_points):
+        angle = 2 * math.pi * i / number_of_points
+        point_radius = radius * rng.uniform(0.8, 1.2)
+        points.append({"x": y + point_radius * math.sin(angle), "y": x + point_radius * math.cos(angle), "z": 0.0})
+    return {"cluster_centroid": {"x": y, "y": x, "z": 0.0}, "area": area, "hull": {"points": points}, "type": cluster_type}
+
+def make_scan(sequence, timestamp, clusters):
+    secs = int(timestamp)
+    nsecs = int(round((timestamp - secs) * 1e9))
+    if nsecs >= 10**9:
+        secs, nsecs = secs + 1, nsecs - 10**9
+    return {"header": {"seq": sequence, "stamp": {"secs": secs, "nsecs": nsecs}, "frame_id": "radar"}, "scan": clusters}
+
+def generate_scans(number_of_scans=500, targets_per_scan=20, number_of_merge_events=10, position_noise=0.5,
+                   clutter_per_scan=5, scan_interval=2.5, start_time=1692450000.0, seed=0):
+    """
+    Generates the scans as a list in the rosbag format.
+    The targets move with constant velocity inside the area, and are moved to a new random position when they leave it.
+    Each merge event is a pair of close clusters in one scan, which are replaced by one larger cluster between them
+    in the next scan. Clutter is added as clusters of other types than 3, which the importer should skip.
+    """
+    rng = random.Random(seed)
+    targets = []
+    for _ in range(targets_per_scan):
+        x, y = random_position(rng)
+        speed = rng.uniform(0, 3)
+        direction = rng.uniform(0, 2 * math.pi)
+        targets.append([x, y, speed * math.cos(direction), speed * math.sin(direction), rng.uniform(2, 40)])
+
+    # The merge events are spread evenly over the scans, leaving room for the scan after each event
+    merge_scans = {}
+    for event in range(number_of_merge_events):
+        merge_scan = int((event + 0.5) * (number_of_scans - 1) / max(number_of_merge_events, 1))
+        merge_scans[merge_scan] = random_position(rng)
+
+    scans = []
+    merged_cluster = None
+    for k in range(number_of_scans):
+        clusters = []
+        for target in targets:
+            target[0] += target[2] * scan_interval
+            target[1] += target[3] * scan_interval
+            if not point_inside_polygon((target[0], target[1]), vertices):
+                target[0], target[1] = random_position(rng)
+            x = target[0] + rng.gauss(0, position_noise)
+            y = target[1] + rng.gauss(0, position_noise)
+            clusters.append(make_cluster(rng, x, y, target[4] * rng.uniform(0.8, 1.2)))
+
+        if merged_cluster is not None:
+            clusters.append(merged_cluster)
+            merged_cluster = None
+        if k in merge_scans:
+            x, y = merge_scans[k]
+            separation = rng.uniform(6, 14)
+            area = rng.uniform(8, 20)
+            clusters.append(make_cluster(rng, x - separation / 2, y, area))
+            clusters.append(make_cluster(rng, x + separation / 2, y, area * rng.uniform(0.8, 1.2)))
+            merged_cluster = make_cluster(rng, x, y, 2.5 * area)
+
+        for _ in range(clutter_per_scan):
+            x, y = random_position(rng)
+            clusters.append(make_cluster(rng, x, y, rng.uniform(0.5, 5), cluster_type=rng.choice([1, 2])))
+        rng.shuffle(clusters)
+        scans.append(make_scan(k, start_time + k * scan_interval, clusters))
+    return scans
+
+def generate_rosbag_json(file_path, **kwargs):
+    """
+    Writes synthetic scans to a json file in the rosbag format, see generate_scans for the arguments
+    """
+    scans = generate_scans(**kwargs)
+    with open(file_path, 'w') as file:
+        json.dump(scans, file)
+    return file_path
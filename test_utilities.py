@@ -0,0 +1,145 @@
+import random
+import numpy as np
+from measurement_frame import MeasurementFrame
+from merged_measurement import ComputeMergeMeasurements
+from utilities import Tracker, area_vertices, euclidean_distance, find_close_pairs, point_inside_polygon, points_inside_polygon
+
+# A polygon with both horizontal and vertical edges
+rectilinear_vertices = [(0, 0), (10, 0), (10, 5), (5, 5), (5, 10), (0, 10)]
+
+def get_test_points(vertices, number_of_random_points=2000, seed=0):
+    """
+    Returns random points around the polygon, every vertex, and points along each edge
+    """
+    rng = random.Random(seed)
+    xs = [x for x, _ in vertices]
+    ys = [y for _, y in vertices]
+    points = [(rng.uniform(min(xs) - 10, max(xs) + 10), rng.uniform(min(ys) - 10, max(ys) + 10)) for _ in range(number_of_random_points)]
+    points += list(vertices)
+    for (p1x, p1y), (p2x, p2y) in zip(vertices, vertices[1:] + vertices[:1]):
+        for t in np.linspace(0, 1, 11).tolist():
+            points.append((p1x + t * (p2x - p1x), p1y + t * (p2y - p1y)))
+    return points
+
+def check_points_inside_polygon(vertices):
+    points = get_test_points(vertices)
+    expected = [point_inside_polygon(point, vertices) for point in points]
+    inside = points_inside_polygon([x for x, _ in points], [y for _, y in points], vertices)
+    assert inside.tolist() == expected
+
+def test_points_inside_polygon_area_vertices():
+    check_points_inside_polygon(area_vertices)
+
+def test_points_inside_polygon_rectilinear():
+    check_points_inside_polygon(rectilinear_vertices)
+
+def get_random_scans(number_of_scans, max_measurements, scale, seed, integer=False):
+    """
+    Returns a measurement_dict of random measurements, where integer coordinates put many points on the cell borders
+    """
+    rng = np.random.default_rng(seed)
+    measurement_dict = {}
+    timestamp = 0.0
+    for _ in range(number_of_scans):
+        timestamp += float(rng.choice([0.5, 1.0, 2.0, 3.99, 4.0, 5.0]))
+        measurements = []
+        for _ in range(int(rng.integers(0, max_measurements + 1))):
+            x, y = rng.uniform(-scale, scale, 2).tolist()
+            if integer:
+                x, y = float(round(x)), float(round(y))
+            measurements.append([x, y, float(rng.uniform(1, 30)), [x, x + 1, x], [y, y, y + 1]])
+        measurement_dict[timestamp] = measurements
+    return measurement_dict
+
+def find_close_pairs_double_loop(xs, ys, max_distance):
+    return [(i, j) for i in range(len(xs)) for j in range(i + 1, len(xs))
+            if euclidean_distance((xs[i], ys[i]), (xs[j], ys[j])) < max_distance]
+
+def test_find_close_pairs():
+    for seed in range(20):
+        integer = seed % 2 == 0
+        for measurements in get_random_scans(5, 60, 30, seed, integer).values():
+            xs = [measurement[0] for measurement in measurements]
+            ys = [measurement[1] for measurement in measurements]
+            for max_distance in [1, 5, 7.5, 20]:
+                i, j = find_close_pairs(xs, ys, max_distance)
+                assert list(zip(i.tolist(), j.tolist())) == find_close_pairs_double_loop(xs, ys, max_distance)
+
+def test_find_close_pairs_on_cell_borders():
+    # Points on the borders of the cells, and pairs exactly max_distance apart, which are not close
+    values = [-10.0, -5.0, -5.0 + 1e-9, 0.0, 5.0 - 1e-9, 5.0, 10.0]
+    xs = [x for x in values for _ in values]
+    ys = [y for _ in values for y in values]
+    i, j = find_close_pairs(xs, ys, 5)
+    assert list(zip(i.tolist(), j.tolist())) == find_close_pairs_double_loop(xs, ys, 5)
+
+def check_find_merge_measurements(measurement_dict):
+    computer = ComputeMergeMeasurements(measurement_dict, "test")
+    computer.verbose = False
+    close_measurements = computer.find_close_measurements()
+    expected = []
+    for close_measurement_object in close_measurements:
+        computer.merged_measurements = []
+        next_timestamp = computer.get_next_key_in_measurement_dict(close_measurement_object.timestamp)
+        computer.check_next_measurement(next_timestamp, close_measurement_object)
+        expected.append(computer.merged_measurements[0] if computer.merged_measurements else None)
+    merge_measurements = computer.find_merge_measurements_for_pairs(close_measurements)
+    assert [merge_measurement is None for merge_measurement in merge_measurements] == [merged is None for merged in expected]
+    for merge_measurement, merged in zip(merge_measurements, expected):
+        if merged is not None:
+            assert repr(merge_measurement) == repr(merged)
+            assert merge_measurement.current_index == merged.current_index
+    return sum(merged is not None for merged in expected)
+
+def test_find_merge_measurements():
+    number_of_merges = 0
+    for seed in range(10):
+        measurement_dict = get_random_scans(30, 12, 25, seed, integer=seed % 2 == 0)
+        number_of_merges += check_find_merge_measurements(measurement_dict)
+        # The columns of a MeasurementFrame are read directly instead of the lists of the measurements
+        number_of_merges += check_find_merge_measurements(MeasurementFrame.from_measurement_dict(measurement_dict))
+    assert number_of_merges > 0
+
+def establish_tracks_all_tracks(measurement_dict, max_distance, max_time):
+    """
+    Copy of the original establish_tracks, which compares each measurement with all the earlier tracks.
+    Returns the track id of each measurement, per timestamp.
+    """
+    tracks = []
+    track_ids = {}
+    for timestamp, measurements in measurement_dict.items():
+        track_ids[timestamp] = []
+        if not tracks:
+            for measurement in measurements:
+                tracks.append([(timestamp, measurement[0], measurement[1])])
+                track_ids[timestamp].append(len(tracks) - 1)
+            continue
+
+        for measurement in measurements:
+            y = measurement[0]
+            x = measurement[1]
+            distances_to_last = [euclidean_distance(track[-1][1:], (x, y)) for track in tracks]
+            distance_to_second_last = [euclidean_distance(track[-2][1:], (x, y)) if len(track) > 1 else 1000 for track in tracks]
+            if min(distances_to_last) < max_distance:
+                track_index = distances_to_last.index(min(distances_to_last))
+            elif min(distance_to_second_last) < max_distance:
+                track_index = distance_to_second_last.index(min(distance_to_second_last))
+            else:
+                track_index = None
+            if track_index is not None and timestamp - tracks[track_index][-1][0] < max_time:
+                tracks[track_index].append((timestamp, x, y))
+            else:
+                tracks.append([(timestamp, x, y)])
+                track_index = len(tracks) - 1
+            track_ids[timestamp].append(track_index)
+    return track_ids
+
+def test_tracker():
+    for seed in range(20):
+        measurement_dict = get_random_scans(30, 12, float(np.random.default_rng(seed).choice([20, 60, 200])), seed, integer=seed % 2 == 0)
+        if seed % 5 == 0:
+            # Tracks are started by the first scan with measurements
+            measurement_dict[next(iter(measurement_dict))] = []
+        tracker = Tracker(15, 4)
+        track_ids = {timestamp: tracker.add_scan(timestamp, measurements) for timestamp, measurements in measurement_dict.items()}
+        assert track_ids == establish_tracks_all_tracks(measurement_dict, 15, 4)
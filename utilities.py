@@ -1,59 +1,288 @@
+import math
 import numpy as np
-from matplotlib.cm import get_cmap
+import instrumentation
+from measurement_frame import MeasurementFrame
 
 class Track:
-    def __init__(self, track_id):
+    """
+    A track, where the timestamp, x and y of the measurements are stored as the rows of an array.
+    The array is preallocated and doubled in size when it is full, such that adding a measurement is cheap.
+    """
+    __slots__ = ("track_id", "points", "number_of_measurements")
+
+    def __init__(self, track_id, capacity=4):
         self.track_id = track_id
-        self.measurements = []
+        self.points = np.empty((capacity, 3))
+        self.number_of_measurements = 0
 
     def add_measurement(self, timestamp, x, y):
-        self.measurements.append({'timestamp': timestamp, 'x': x, 'y': y})
+        if self.number_of_measurements == len(self.points):
+            points = np.empty((2 * len(self.points), 3))
+            points[:self.number_of_measurements] = self.points
+            self.points = points
+        self.points[self.number_of_measurements] = (timestamp, x, y)
+        self.number_of_measurements += 1
+
+    def keep_last_measurements(self, number_of_measurements):
+        # Removes all but the last number_of_measurements measurements
+        if self.number_of_measurements > number_of_measurements:
+            self.points[:number_of_measurements] = self.points[self.number_of_measurements-number_of_measurements:self.number_of_measurements]
+            self.number_of_measurements = number_of_measurements
+
+    def get_point(self, index):
+        # Returns the (timestamp, x, y) of the measurement at index, where negative indices count from the end
+        if index < 0:
+            index += self.number_of_measurements
+        return self.points[index].tolist()
+
+    @property
+    def timestamps(self):
+        return self.points[:self.number_of_measurements, 0]
+
+    @property
+    def xs(self):
+        return self.points[:self.number_of_measurements, 1]
+
+    @property
+    def ys(self):
+        return self.points[:self.number_of_measurements, 2]
 
     def sort_by_timestamp(self):
-        self.measurements = sorted(self.measurements, key=lambda k: k['timestamp'])
+        order = np.argsort(self.timestamps, kind='stable')
+        self.points[:self.number_of_measurements] = self.points[order]
 
     def calculate_distance(self):
-        if len(self.measurements) < 2:
+        if self.number_of_measurements < 2:
             return 0.0  # Distance is zero if there's only one measurement
 
-        start_point = (self.measurements[0]['x'], self.measurements[0]['y'])
-        end_point = (self.measurements[-1]['x'], self.measurements[-1]['y'])
+        start_point = (self.xs[0], self.ys[0])
+        end_point = (self.xs[-1], self.ys[-1])
         return euclidean_distance(start_point, end_point)
     
     def total_distance(self):
-        total_distance = 0
-        for i in range(len(self.measurements)-1):
-            total_distance += euclidean_distance((self.measurements[i]['x'], self.measurements[i]['y']), (self.measurements[i+1]['x'], self.measurements[i+1]['y']))
-        return total_distance
+        return np.sum(np.sqrt(np.diff(self.xs) ** 2 + np.diff(self.ys) ** 2))
+
+    def __len__(self):
+        return self.number_of_measurements
 
     def __repr__(self) -> str:
-        temp_str = f"Track {self.track_id} with {len(self.measurements)} measurements\n"
-        for measurement in self.measurements:
-            temp_str += f"Timestamp: {measurement['timestamp']:.2f}, x: {measurement['x']:.2f}, y: {measurement['y']:.2f}\n"
+        temp_str = f"Track {self.track_id} with {self.number_of_measurements} measurements\n"
+        for timestamp, x, y in self.points[:self.number_of_measurements].tolist():
+            temp_str += f"Timestamp: {timestamp:.2f}, x: {x:.2f}, y: {y:.2f}\n"
         return temp_str  
 
+class SpatialHash:
+    """
+    Uniform grid for finding the ids of the points that are within cell_size of a position
+    """
+    def __init__(self, cell_size):
+        # The cells are made slightly larger than cell_size, such that rounding can not put close points two cells apart
+        self.cell_size = cell_size * (1 + 1e-6)
+        self.cells = {}
+
+    def get_cell(self, x, y):
+        return (math.floor(x / self.cell_size), math.floor(y / self.cell_size))
+
+    def insert(self, item_id, x, y):
+        self.cells.setdefault(self.get_cell(x, y), set()).add(item_id)
+
+    def remove(self, item_id, x, y):
+        cell = self.get_cell(x, y)
+        items = self.cells[cell]
+        items.discard(item_id)
+        if not items:
+            del self.cells[cell]
+
+    def query(self, x, y):
+        """
+        Returns the ids in the cells around the position, which include all points closer than cell_size
+        """
+        cell_x, cell_y = self.get_cell(x, y)
+        item_ids = []
+        for dx in (-1, 0, 1):
+            for dy in (-1, 0, 1):
+                item_ids.extend(self.cells.get((cell_x + dx, cell_y + dy), ()))
+        return item_ids
+
+class Tracker:
+    """
+    Establishes tracks incrementally, one scan at a time, by linking measurements that are close in space and time.
+    The last and second-last positions of the tracks are kept in spatial hashes, such that a new measurement is only
+    compared with the tracks that are close to it. Only the active tracks, which have been updated within max_time,
+    can be extended. An expired track can still be the closest track to a new measurement, which then starts a new track
+    instead, so expired tracks are kept in the spatial hashes until expired_track_lifetime has passed since their last
+    measurement. With None they are kept forever, which gives the same tracks as comparing with all earlier tracks, but
+    the association gets slower with the length of the recording. A finite lifetime keeps it fast, but can change the tracks.
+    """
+    def __init__(self, max_distance, max_time, expired_track_lifetime=None, history_length=None):
+        self.max_distance = max_distance
+        self.max_time = max_time
+        self.expired_track_lifetime = expired_track_lifetime
+        # If given, only the last history_length measurements of each track are kept
+        self.history_length = history_length
+        self.tracks = {}
+        # The ids of the active and expired tracks, both in the order of their last measurement
+        self.active_tracks = {}
+        self.expired_tracks = {}
+        self.last_positions = SpatialHash(max_distance)
+        self.second_last_positions = SpatialHash(max_distance)
+        self.track_counter = 0
+
+    def expire_tracks(self, timestamp):
+        # Moves the tracks that have not been updated for max_time to the expired tracks, and removes the expired tracks
+        # whose last measurement is older than expired_track_lifetime
+        for track_id in list(self.active_tracks):
+            if timestamp - self.tracks[track_id].get_point(-1)[0] < self.max_time:
+                break
+            del self.active_tracks[track_id]
+            self.expired_tracks[track_id] = None
+        if self.expired_track_lifetime is None:
+            return
+        for track_id in list(self.expired_tracks):
+            track = self.tracks[track_id]
+            if timestamp - track.get_point(-1)[0] < self.expired_track_lifetime:
+                break
+            self.remove_track(track)
+
+    def remove_track(self, track):
+        self.last_positions.remove(track.track_id, *track.get_point(-1)[1:])
+        if len(track) > 1:
+            self.second_last_positions.remove(track.track_id, *track.get_point(-2)[1:])
+        del self.tracks[track.track_id]
+        del self.expired_tracks[track.track_id]
+
+    def new_track(self, timestamp, x, y):
+        track = Track(self.track_counter)
+        track.add_measurement(timestamp, x, y)
+        self.tracks[track.track_id] = track
+        self.active_tracks[track.track_id] = None
+        self.last_positions.insert(track.track_id, x, y)
+        self.track_counter += 1
+        return track.track_id
+
+    def extend_track(self, track, timestamp, x, y):
+        _, last_x, last_y = track.get_point(-1)
+        if len(track) > 1:
+            self.second_last_positions.remove(track.track_id, *track.get_point(-2)[1:])
+        self.second_last_positions.insert(track.track_id, last_x, last_y)
+        self.last_positions.remove(track.track_id, last_x, last_y)
+        track.add_measurement(timestamp, x, y)
+        if self.history_length is not None:
+            track.keep_last_measurements(self.history_length)
+        self.last_positions.insert(track.track_id, x, y)
+        # Moved to the end, since it now has the latest measurement
+        del self.active_tracks[track.track_id]
+        self.active_tracks[track.track_id] = None
+        return track.track_id
+
+    def find_closest_track(self, positions, index, x, y):
+        """
+        Returns the closest track closer than max_distance, where the distance is measured to the measurement at
+        index (-1 for last, -2 for second-last) in the track. Ties are resolved by the lowest track id.
+        """
+        closest = None
+        for track_id in positions.query(x, y):
+            _, track_x, track_y = self.tracks[track_id].get_point(index)
+            distance = euclidean_distance((track_x, track_y), (x, y))
+            if distance < self.max_distance and (closest is None or (distance, track_id) < closest):
+                closest = (distance, track_id)
+        if closest is None:
+            return None
+        return self.tracks[closest[1]]
+
+    def add_scan(self, timestamp, measurements):
+        """
+        Adds the measurements of a scan to the tracks, and returns the track id of each measurement
+        """
+        self.expire_tracks(timestamp)
+        if self.track_counter == 0:
+            # Initialize tracks with the first set of measurements if no tracks are made yet.
+            return [self.new_track(timestamp, measurement[0], measurement[1]) for measurement in measurements]
+
+        track_ids = []
+        for measurement in measurements:
+            y = measurement[0]
+            x = measurement[1]
+            # Try the last points in the tracks first, and then the second-last points.
+            track = self.find_closest_track(self.last_positions, -1, x, y)
+            if track is None:
+                track = self.find_closest_track(self.second_last_positions, -2, x, y)
+
+            # If the track is still active, add the measurement to the track, otherwise start a new track.
+            if track is not None and track.track_id in self.active_tracks:
+                track_ids.append(self.extend_track(track, timestamp, x, y))
+            else:
+                track_ids.append(self.new_track(timestamp, x, y))
+        return track_ids
+
 def euclidean_distance(point1, point2):
     return np.sqrt((point1[0] - point2[0]) ** 2 + (point1[1] - point2[1]) ** 2)
 
-def add_color_scaling(measurement_dict):
-    data = measurement_dict
-    cmap = get_cmap('Greys')
-    timestamps = []
-    for timestamp, measurements in data.items():
-        timestamps.append(timestamp)
-    timestamps = np.asarray(timestamps)
-    interval = (timestamps-timestamps[0]+timestamps[-1]/5)/(timestamps[-1]-timestamps[0]+timestamps[-1]/5)
+def find_close_pairs(xs, ys, max_distance):
+    """
+    Finds all pairs (i, j), i < j, of points closer than max_distance to each other, using a uniform grid with
+    cells of size max_distance, such that only points in neighbouring cells are compared.
+    The pairs are returned sorted by i and then j, which is the same order as a double loop over the points.
+    """
+    x = np.asarray(xs, dtype=float)
+    y = np.asarray(ys, dtype=float)
+    empty = (np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64))
+    if len(x) < 2 or not max_distance > 0:
+        return empty
 
-    for timestamp, measurements in data.items():
-        # Iterate over each measurement and assign a color based on position
-        for index, measurement in enumerate(measurements):
-            measurement_color = cmap(interval[timestamps == timestamp])
+    # The cells are made slightly larger than max_distance, such that rounding can not put close points two cells apart
+    cell_size = max_distance * (1 + 1e-6)
+    cell_x = np.floor(x / cell_size).astype(np.int64)
+    cell_y = np.floor(y / cell_size).astype(np.int64)
+    cell_x -= cell_x.min() - 1
+    cell_y -= cell_y.min() - 1
+    width = cell_y.max() + 2
+    cell_keys = cell_x * width + cell_y
+    order = np.argsort(cell_keys, kind='stable')
+    sorted_keys = cell_keys[order]
 
-            # Append the color value to the measurement
-            measurement.append(measurement_color.squeeze())
-           
+    first = []
+    second = []
+    for dx in (-1, 0, 1):
+        for dy in (-1, 0, 1):
+            neighbour_keys = (cell_x + dx) * width + cell_y + dy
+            start = np.searchsorted(sorted_keys, neighbour_keys, side='left')
+            counts = np.searchsorted(sorted_keys, neighbour_keys, side='right') - start
+            total = counts.sum()
+            if total == 0:
+                continue
+            i = np.repeat(np.arange(len(x)), counts)
+            positions = np.repeat(start - np.cumsum(counts) + counts, counts) + np.arange(total)
+            j = order[positions]
+            keep = i < j
+            first.append(i[keep])
+            second.append(j[keep])
+    if not first:
+        return empty
 
-    return data
+    i = np.concatenate(first)
+    j = np.concatenate(second)
+    distances = np.sqrt((x[i] - x[j]) ** 2 + (y[i] - y[j]) ** 2)
+    close = distances < max_distance
+    i, j = i[close], j[close]
+    order = np.lexsort((j, i))
+    return i[order], j[order]
+
+def get_scan_colors(timestamps):
+    """
+    Returns the color of each scan as an array with one RGBA row per timestamp, where later scans are darker
+    """
+    # Imported here, such that the detection can run without matplotlib
+    from matplotlib import colormaps
+    cmap = colormaps['Greys']
+    timestamps = np.asarray(timestamps, dtype=float)
+    if len(timestamps) == 0:
+        return np.zeros((0, 4))
+    interval = (timestamps-timestamps[0]+timestamps[-1]/5)/(timestamps[-1]-timestamps[0]+timestamps[-1]/5)
+    return cmap(interval)
+
+# The area where merged measurements are looked for
+area_vertices = [(100, 0), (100, -40), (0, -80), (-50,-110), (-90, -120), (-105, -110),(-50,-60),(-25,-20),(0,0)]
 
 def point_inside_polygon(measurement, vertices):
     """
@@ -76,13 +305,58 @@ def point_inside_polygon(measurement, vertices):
         p1x, p1y = p2x, p2y
     return inside
 
+def points_inside_polygon(xs, ys, vertices):
+    """
+    Vectorized version of point_inside_polygon, which checks all the points given by xs and ys at once.
+    Uses the same ray casting as point_inside_polygon, edge by edge, such that points on edges and vertices
+    get the same result.
+    """
+    x = np.asarray(xs, dtype=float)
+    y = np.asarray(ys, dtype=float)
+    inside = np.zeros(x.shape, dtype=bool)
+    n = len(vertices)
+    p1x, p1y = vertices[0]
+    for i in range(n + 1):
+        p2x, p2y = vertices[i % n]
+        # Horizontal edges are never crossed, since y can not be both above min and below or at max
+        if p1y != p2y:
+            crossing = (y > min(p1y, p2y)) & (y <= max(p1y, p2y)) & (x <= max(p1x, p2x))
+            if p1x != p2x:
+                xinters = (y - p1y) * (p2x - p1x) / (p2y - p1y) + p1x
+                crossing &= x <= xinters
+            inside ^= crossing
+        p1x, p1y = p2x, p2y
+    return inside
+
 def filter_out_measurements_outside_area(measurement_dict,vertices):
-    new_measurement_dict = {}
-    for timestamp, measurements in measurement_dict.items():
-        new_measurement_dict[timestamp] = []
-        for measurement in measurements:
-            if point_inside_polygon((measurement[0], measurement[1]), vertices):
-                new_measurement_dict[timestamp].append(measurement)
-    return new_measurement_dict
+    with instrumentation.stage("filter"):
+        if isinstance(measurement_dict, MeasurementFrame):
+            inside = points_inside_polygon(measurement_dict.x, measurement_dict.y, vertices)
+            instrumentation.count("measurements_inside_area", int(np.count_nonzero(inside)))
+            return measurement_dict.select(inside)
+
+        # Check the centroids of the whole file at once
+        xs = [measurement[0] for measurements in measurement_dict.values() for measurement in measurements]
+        ys = [measurement[1] for measurements in measurement_dict.values() for measurement in measurements]
+        inside = points_inside_polygon(xs, ys, vertices).tolist()
+        instrumentation.count("measurements_inside_area", sum(inside))
 
+        new_measurement_dict = {}
+        k = 0
+        for timestamp, measurements in measurement_dict.items():
+            new_measurement_dict[timestamp] = []
+            for measurement in measurements:
+                if inside[k]:
+                    new_measurement_dict[timestamp].append(measurement)
+                k += 1
+        return new_measurement_dict
 
+
+def filter_scans_outside_area(scans, vertices):
+    """
+    Streaming version of filter_out_measurements_outside_area, which takes an iterable of (timestamp, measurements)
+    and yields the scans with only the measurements inside the polygon
+    """
+    for timestamp, measurements in scans:
+        inside = points_inside_polygon([measurement[0] for measurement in measurements], [measurement[1] for measurement in measurements], vertices)
+        yield timestamp, [measurement for measurement, is_inside in zip(measurements, inside) if is_inside]